@@ -17,6 +17,7 @@ HELPTEXT = 'Hold uppercase key for recording,\nlowercase for playback'
 REC_OFF = '#600'
 REC_ON = '#e00'
 BUFFER_DURATION = 0.1  # seconds
+FADE_DURATION = 0.01  # seconds
 
 
 class Sample(object):
@@ -76,7 +77,7 @@ class MiniSampler(tk.Tk, tkhelper.KeyEventDebouncer):
         if ch not in self.samples:
             return
         sample = self.samples[ch]
-        # TODO: fade out (both recording and playback)?
+        # TODO: fade out recording?
         assert sample.action is not None
         if sample.action.type == rtmixer.RECORD_RINGBUFFER:
             # Stop recording
@@ -88,7 +89,9 @@ class MiniSampler(tk.Tk, tkhelper.KeyEventDebouncer):
             # Stop playback (if still running)
             if sample.action in self.stream.actions:
                 sample.keep_alive = sample.action
-                sample.action = self.stream.cancel(sample.action)
+                sample.action = self.stream.cancel(
+                    sample.action,
+                    fade_out=int(FADE_DURATION * self.stream.samplerate))
                 # TODO: do something with sample.action?
         elif sample.action.type == rtmixer.CANCEL:
             # We might end up here if on_key_press() exits early
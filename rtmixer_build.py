@@ -16,6 +16,25 @@ ffibuilder.cdef("""
 
 """)
 ffibuilder.cdef(open('src/rtmixer.h').read())
+ffibuilder.cdef("""
+
+/* More declarations from portaudio.h (needed for calling the callback): */
+
+struct PaStreamCallbackTimeInfo
+{
+  PaTime inputBufferAdcTime;
+  PaTime currentTime;
+  PaTime outputBufferDacTime;
+};
+
+typedef enum PaStreamCallbackResult
+{
+  paContinue = 0,
+  paComplete = 1,
+  paAbort = 2,
+} PaStreamCallbackResult;
+
+""")
 # '-Wconversion'
 extra_compile_args = list()
 if sys.platform == "linux":
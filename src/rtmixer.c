@@ -1,13 +1,26 @@
 /* See ../rtmixer_build.py, the ring buffer declarations are included there */
 
-#include <math.h>  // for llround()
+#if !defined(_WIN32) && !defined(_POSIX_C_SOURCE)
+#define _POSIX_C_SOURCE 199309L  // for clock_gettime()
+#endif
+
+#include <limits.h>  // for ULONG_MAX
+#include <math.h>  // for llround(), lrint(), lrintf()
 #include <stdbool.h>
+#include <stdint.h>  // for int16_t, int32_t
 #include <stdio.h>  // for printf()
-#include <string.h>  // for memset()
+#include <string.h>  // for memset(), memcpy(), memmove()
+#ifdef _WIN32
+#include <windows.h>  // for QueryPerformanceCounter()
+#else
+#include <time.h>  // for clock_gettime()
+#include <unistd.h>  // for write()
+#endif
 #include <portaudio.h>
 #include "rtmixer.h"
 
 static const struct stats EMPTY_STATS;
+static const struct timing EMPTY_TIMING;
 
 #ifdef NDEBUG
 #define CALLBACK_ASSERT(expr) ((void)(0))
@@ -20,134 +33,1496 @@ static const struct stats EMPTY_STATS;
   }} while (false)
 #endif
 
-void remove_action(struct action** addr, const struct state* state)
+// Monotonic clock in seconds (with arbitrary offset)
+double get_clock(void)
+{
+#ifdef _WIN32
+  LARGE_INTEGER counter, frequency;
+  QueryPerformanceCounter(&counter);
+  QueryPerformanceFrequency(&frequency);
+  return (double)counter.QuadPart / (double)frequency.QuadPart;
+#else
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (double)ts.tv_sec + (double)ts.tv_nsec * 1e-9;
+#endif
+}
+
+void get_jitter(frame_t frameCount, PaTime time, struct state* state)
+{
+  if (state->last_frames)
+  {
+    double expected = state->last_time
+      + (double)state->last_frames / state->samplerate;
+    double jitter = fabs(time - expected);
+    struct timing* timing = &(state->timing);
+    timing->jitter_blocks++;
+    timing->total_jitter += jitter;
+    if (jitter > timing->max_jitter)
+    {
+      timing->max_jitter = jitter;
+    }
+  }
+  state->last_time = time;
+  state->last_frames = frameCount;
+}
+
+void get_timing(frame_t frameCount, double elapsed, struct state* state)
+{
+  struct timing* timing = &(state->timing);
+  timing->blocks++;
+  timing->total_time += elapsed;
+  if (elapsed > timing->max_time)
+  {
+    timing->max_time = elapsed;
+  }
+  double load = elapsed * state->samplerate / (double)frameCount;
+  if (load > timing->max_load)
+  {
+    timing->max_load = load;
+  }
+  int bin = (int)(load * 10.0);
+  if (bin >= LOAD_HISTOGRAM_SIZE)
+  {
+    bin = LOAD_HISTOGRAM_SIZE - 1;
+  }
+  timing->load_histogram[bin]++;
+}
+
+void trace_event(enum eventtype type, const struct action* action
+  , PaTime time, frame_t value, struct state* state)
+{
+  if (!state->trace)
+  {
+    return;
+  }
+  struct event event;
+  event.type = type;
+  event.action_type = action ? action->type : PLAY_BUFFER;
+  event.action = action;
+  event.time = time;
+  event.value = value;
+  if (PaUtil_WriteRingBuffer(state->trace, &event, 1) != 1)
+  {
+    state->lost_events++;
+  }
+}
+
+// Filter currentTime with a delay-locked loop (see "Using a DLL to filter
+// time" by Fons Adriaensen), the loop estimates the duration of a frame
+void update_drift(frame_t frameCount, PaTime time, struct state* state)
+{
+  struct drift* drift = &(state->drift);
+  if (drift->period == 0.0)
+  {
+    drift->period = 1.0 / state->samplerate;
+    drift->predicted = time + (double)frameCount * drift->period;
+    return;
+  }
+  double error = time - drift->predicted;
+  if (fabs(error) > (double)frameCount * drift->period)
+  {
+    // Dropped blocks or unreliable timestamps, only the phase is reset
+    drift->predicted = time + (double)frameCount * drift->period;
+    return;
+  }
+  double omega = 2.0 * 3.141592653589793 * drift->bandwidth
+    * (double)frameCount * drift->period;
+  drift->predicted += sqrt(2.0) * omega * error
+    + (double)frameCount * drift->period;
+  drift->period += omega * omega * error / (double)frameCount;
+}
+
+bool is_playback_or_recording(const struct action* action)
+{
+  return action->type == PLAY_BUFFER || action->type == PLAY_RINGBUFFER
+      || action->type == RECORD_BUFFER || action->type == RECORD_RINGBUFFER;
+}
+
+// Stream time at the current position of the action
+PaTime get_action_time(const struct action* action, const struct state* state)
+{
+  if (action->started)
+  {
+    double frames = (double)action->done_frames;
+    if (action->resampler.step > 0.0)
+    {
+      // Convert to device frames
+      if (action->type == RECORD_BUFFER || action->type == RECORD_RINGBUFFER)
+      {
+        frames *= action->resampler.step;
+      }
+      else
+      {
+        frames /= action->resampler.step;
+      }
+    }
+    return action->actual_time + frames / state->samplerate;
+  }
+  return action->requested_time;
+}
+
+void finish_action(struct action* action, struct state* state)
+{
+  if (state->trace && is_playback_or_recording(action))
+  {
+    trace_event(ACTION_FINISHED, action, get_action_time(action, state)
+      , action->done_frames, state);
+  }
+  ring_buffer_size_t written = 0;
+  if (!state->finished)
+  {
+    written = PaUtil_WriteRingBuffer(state->result_q, &action, 1);
+  }
+  if (written == 1)
+  {
+    state->notify = true;
+    frame_t used = (frame_t)PaUtil_GetRingBufferReadAvailable(state->result_q);
+    if (used > state->max_result_q)
+    {
+      state->max_result_q = used;
+    }
+    return;
+  }
+  // The result queue is full (or there are already actions waiting),
+  // the action is held back until there is room in the result queue.
+  action->next = state->finished;
+  state->finished = action;
+  state->finished_count++;
+  if (state->finished_count > state->max_finished)
+  {
+    state->max_finished = state->finished_count;
+  }
+}
+
+void flush_finished_actions(struct state* state)
+{
+  while (state->finished)
+  {
+    struct action* action = state->finished;
+    if (PaUtil_WriteRingBuffer(state->result_q, &action, 1) != 1)
+    {
+      return;
+    }
+    state->finished = action->next;
+    state->finished_count--;
+    action->next = NULL;
+    state->notify = true;
+    frame_t used = (frame_t)PaUtil_GetRingBufferReadAvailable(state->result_q);
+    if (used > state->max_result_q)
+    {
+      state->max_result_q = used;
+    }
+  }
+}
+
+void notify_finished(struct state* state)
+{
+  state->notify = false;
+#ifndef _WIN32
+  if (state->notify_fd >= 0)
+  {
+    // The pipe is non-blocking, if it is full, a wake-up is pending anyway
+    const char byte = 0;
+    ssize_t written = write(state->notify_fd, &byte, 1);
+    (void)written;
+  }
+#endif
+}
+
+void remove_action(struct action** addr, struct state* state)
+{
+  struct action* action = *addr;
+  *addr = action->next;  // Current action is removed from list
+  if (state->actions_tail == &(action->next))
+  {
+    state->actions_tail = addr;
+  }
+  action->next = NULL;
+  finish_action(action, state);
+}
+
+void get_stats(frame_t frameCount, PaStreamCallbackFlags flags
+  , struct stats* stats)
+{
+  if (stats->blocks == 0)
+  {
+    stats->min_blocksize = frameCount;
+    stats->max_blocksize = frameCount;
+  }
+  else
+  {
+    if (frameCount < stats->min_blocksize)
+    {
+      stats->min_blocksize = frameCount;
+    }
+    if (frameCount > stats->max_blocksize)
+    {
+      stats->max_blocksize = frameCount;
+    }
+  }
+  stats->blocks++;
+
+  if (flags & paInputUnderflow)  { stats->input_underflows++; }
+  if (flags & paInputOverflow)   { stats->input_overflows++; }
+  if (flags & paOutputUnderflow) { stats->output_underflows++; }
+  if (flags & paOutputOverflow)  { stats->output_overflows++; }
+}
+
+// Actions that are not yet due are stored in a "pairing heap", sorted by
+// requested_time.  The heap is made of the actions themselves: "child" points
+// to the first child, "next" to the next sibling and "prev" to the previous
+// sibling (or to the parent in case of the first child).
+// This way, insertion is O(1) and removal is amortized O(log n), without any
+// memory allocation.
+
+struct action* heap_meld(struct action* a, struct action* b)
+{
+  if (!a) { return b; }
+  if (!b) { return a; }
+  if (b->requested_time < a->requested_time)
+  {
+    struct action* temp = a;
+    a = b;
+    b = temp;
+  }
+  // "b" becomes the first child of "a"
+  b->prev = a;
+  b->next = a->child;
+  if (a->child)
+  {
+    a->child->prev = b;
+  }
+  a->child = b;
+  return a;
+}
+
+// Two-pass pairing of a list of siblings, returns new (sub-)heap
+struct action* heap_merge_pairs(struct action* first)
+{
+  struct action* pairs = NULL;  // Melded pairs in reversed order
+  while (first)
+  {
+    struct action* a = first;
+    struct action* b = a->next;
+    first = b ? b->next : NULL;
+    a->next = a->prev = NULL;
+    if (b)
+    {
+      b->next = b->prev = NULL;
+      a = heap_meld(a, b);
+    }
+    a->next = pairs;
+    pairs = a;
+  }
+  struct action* result = NULL;
+  while (pairs)
+  {
+    struct action* next = pairs->next;
+    pairs->next = NULL;
+    result = heap_meld(result, pairs);
+    pairs = next;
+  }
+  return result;
+}
+
+bool is_pending(const struct action* action, const struct state* state)
+{
+  return action == state->pending || action->prev;
+}
+
+void remove_pending(struct action* action, struct state* state)
+{
+  if (action == state->pending)
+  {
+    state->pending = heap_merge_pairs(action->child);
+  }
+  else
+  {
+    if (action->prev->child == action)
+    {
+      action->prev->child = action->next;
+    }
+    else
+    {
+      action->prev->next = action->next;
+    }
+    if (action->next)
+    {
+      action->next->prev = action->prev;
+    }
+    state->pending = heap_meld(state->pending
+      , heap_merge_pairs(action->child));
+  }
+  action->child = action->next = action->prev = NULL;
+}
+
+// CANCEL actions are inserted in the front, others in the back of the list.
+void activate_action(struct action* action, struct state* state)
+{
+  if (!state->actions_tail)
+  {
+    state->actions_tail = &(state->actions);
+  }
+  if (action->type == CANCEL || action->type == ENVELOPE)
+  {
+    action->next = state->actions;
+    state->actions = action;
+    if (!action->next)
+    {
+      state->actions_tail = &(action->next);
+    }
+  }
+  else
+  {
+    action->next = NULL;
+    *(state->actions_tail) = action;
+    state->actions_tail = &(action->next);
+  }
+}
+
+// Actions that may start before "horizon" are activated immediately, all
+// others are stored in the heap of pending actions.
+// Linked lists of actions are supported.
+void get_new_actions(struct state* state, PaTime horizon)
+{
+  for (struct action* new_action = NULL
+      ; PaUtil_ReadRingBuffer(state->action_q, &new_action, 1)
+      ;)
+  {
+    do
+    {
+      struct action* next = new_action->next;
+      if (new_action->requested_time < horizon)
+      {
+        activate_action(new_action, state);
+      }
+      else
+      {
+        // The action is too early (which means it cannot be belated)
+        new_action->actual_time = -1.0;
+        new_action->next = new_action->prev = new_action->child = NULL;
+        state->pending = heap_meld(state->pending, new_action);
+      }
+      new_action = next;
+    }
+    while (new_action);
+  }
+
+  while (state->pending && state->pending->requested_time < horizon)
+  {
+    struct action* action = state->pending;
+    remove_pending(action, state);
+    activate_action(action, state);
+  }
+}
+
+frame_t seconds2samples(PaTime time, double samplerate)
+{
+  return (frame_t) llround(time * samplerate);
+}
+
+PaTime get_relevant_time(const struct action* action
+  , const PaStreamCallbackTimeInfo* timeInfo)
+{
+  enum actiontype type = action->type;
+  if (type == CANCEL)
+  {
+    CALLBACK_ASSERT(action->action);
+    type = action->action->type;
+  }
+
+  switch (type)
+  {
+    case PLAY_BUFFER:
+    case PLAY_RINGBUFFER:
+    // The output of these is heard at the same time as playback:
+    case ROUTE:
+    case CONVOLVE:
+    case SET_OUTPUT_PROCESSING:
+      return timeInfo->outputBufferDacTime;
+    case RECORD_BUFFER:
+    case RECORD_RINGBUFFER:
+      return timeInfo->inputBufferAdcTime;
+    default:
+      return timeInfo->currentTime;
+  }
+}
+
+// Conversion from float to the integer sample formats (with clipping).
+// The float samples are expected to be in the range [-1.0, 1.0).
+
+float float_to_float(float value)
+{
+  return value;
+}
+
+int16_t float_to_int16(float value)
+{
+  value *= 32768.0f;
+  if (value >= 32767.0f) { return INT16_MAX; }
+  if (value <= -32768.0f) { return INT16_MIN; }
+  return (int16_t)lrintf(value);
+}
+
+int32_t float_to_int32(float value)
+{
+  double scaled = (double)value * 2147483648.0;
+  if (scaled >= 2147483647.0) { return INT32_MAX; }
+  if (scaled <= -2147483648.0) { return INT32_MIN; }
+  return (int32_t)lrint(scaled);
+}
+
+// Scaling factor from the given sample format to float
+float get_scale(enum sampleformat format)
+{
+  switch (format)
+  {
+    case INT16_FORMAT:
+      return 1.0f / 32768.0f;
+    case INT32_FORMAT:
+      return 1.0f / 2147483648.0f;
+    default:
+      return 1.0f;
+  }
+}
+
+// The following functions expect the channel mapping to be checked already.
+// The specialized loops for the different layouts can be auto-vectorized.
+// They are instantiated for each sample format with the following macros.
+
+#define MIX_FRAMES_LOOPS(TYPE) \
+  do { \
+    const TYPE* in = buffer; \
+    switch (action->layout) \
+    { \
+      case IDENTITY_LAYOUT: \
+        for (frame_t i = 0; i < frames * channels; i++) \
+        { \
+          device_data[i] += gain * (float)in[i]; \
+        } \
+        break; \
+      case CONTIGUOUS_LAYOUT: \
+        device_data += action->mapping[0] - 1; \
+        for (frame_t f = 0; f < frames; f++) \
+        { \
+          for (frame_t c = 0; c < channels; c++) \
+          { \
+            device_data[c] += gain * (float)in[c]; \
+          } \
+          device_data += device_channels; \
+          in += channels; \
+        } \
+        break; \
+      case SINGLE_CHANNEL_LAYOUT: \
+        device_data += action->mapping[0] - 1; \
+        for (frame_t f = 0; f < frames; f++) \
+        { \
+          device_data[f * device_channels] += gain * (float)in[f]; \
+        } \
+        break; \
+      case MATRIX_LAYOUT: \
+        /* One multiply-add over the block per entry, like above */ \
+        for (frame_t e = 0; e < action->matrix->size; e++) \
+        { \
+          const struct matrixentry* entry = action->matrix->entries + e; \
+          const float entry_gain = gain * entry->gain; \
+          float* out = device_data + entry->output; \
+          const TYPE* source = in + entry->input; \
+          for (frame_t f = 0; f < frames; f++) \
+          { \
+            out[f * device_channels] \
+              += entry_gain * (float)source[f * channels]; \
+          } \
+        } \
+        break; \
+      default: \
+        for (frame_t f = 0; f < frames; f++) \
+        { \
+          for (frame_t c = 0; c < channels; c++) \
+          { \
+            device_data[action->mapping[c] - 1] += gain * (float)in[c]; \
+          } \
+          device_data += device_channels; \
+          in += channels; \
+        } \
+    } \
+  } while (false)
+
+#define COPY_FRAMES_LOOPS(TYPE, CONVERT) \
+  do { \
+    TYPE* out = buffer; \
+    switch (action->layout) \
+    { \
+      case IDENTITY_LAYOUT: \
+        for (frame_t i = 0; i < frames * channels; i++) \
+        { \
+          out[i] = CONVERT(device_data[i]); \
+        } \
+        break; \
+      case CONTIGUOUS_LAYOUT: \
+        device_data += action->mapping[0] - 1; \
+        for (frame_t f = 0; f < frames; f++) \
+        { \
+          for (frame_t c = 0; c < channels; c++) \
+          { \
+            out[c] = CONVERT(device_data[c]); \
+          } \
+          device_data += device_channels; \
+          out += channels; \
+        } \
+        break; \
+      case SINGLE_CHANNEL_LAYOUT: \
+        device_data += action->mapping[0] - 1; \
+        for (frame_t f = 0; f < frames; f++) \
+        { \
+          out[f] = CONVERT(device_data[f * device_channels]); \
+        } \
+        break; \
+      default: \
+        for (frame_t f = 0; f < frames; f++) \
+        { \
+          for (frame_t c = 0; c < channels; c++) \
+          { \
+            out[c] = CONVERT(device_data[action->mapping[c] - 1]); \
+          } \
+          device_data += device_channels; \
+          out += channels; \
+        } \
+    } \
+  } while (false)
+
+void mix_frames(const struct action* action, const void* buffer
+  , float* device_data, frame_t device_channels, frame_t frames, float gain)
+{
+  const frame_t channels = action->channels;
+  // Integer samples are scaled together with the gain
+  gain *= get_scale(action->format);
+  switch (action->format)
+  {
+    case INT16_FORMAT:
+      MIX_FRAMES_LOOPS(int16_t);
+      break;
+    case INT32_FORMAT:
+      MIX_FRAMES_LOOPS(int32_t);
+      break;
+    default:
+      MIX_FRAMES_LOOPS(float);
+  }
+}
+
+void copy_frames(const struct action* action, const float* device_data
+  , frame_t device_channels, void* buffer, frame_t frames)
+{
+  const frame_t channels = action->channels;
+  switch (action->format)
+  {
+    case INT16_FORMAT:
+      COPY_FRAMES_LOOPS(int16_t, float_to_int16);
+      break;
+    case INT32_FORMAT:
+      COPY_FRAMES_LOOPS(int32_t, float_to_int32);
+      break;
+    default:
+      COPY_FRAMES_LOOPS(float, float_to_float);
+  }
+}
+
+// Get a single sample as float (without any scaling)
+float get_sample(enum sampleformat format, const void* buffer, frame_t index)
+{
+  switch (format)
+  {
+    case INT16_FORMAT:
+      return (float)((const int16_t*)buffer)[index];
+    case INT32_FORMAT:
+      return (float)((const int32_t*)buffer)[index];
+    default:
+      return ((const float*)buffer)[index];
+  }
+}
+
+// Gain (including fade-in/out) for a given frame (counted from the start)
+float get_gain(const struct action* action, frame_t position)
+{
+  float gain = action->gain;
+  if (position < action->fade_in)
+  {
+    gain *= (float)(position + 1) / (float)(action->fade_in + 1);
+  }
+  if (action->total_frames - position <= action->fade_out)
+  {
+    gain *= (float)(action->total_frames - position)
+          / (float)(action->fade_out + 1);
+  }
+  return gain;
+}
+
+// Fades are short, therefore the generic loop is good enough here
+void mix_frames_ramp(const struct action* action, frame_t position
+  , const void* buffer, float* device_data, frame_t device_channels
+  , frame_t frames)
+{
+  const frame_t channels = action->channels;
+  const float scale = get_scale(action->format);
+  frame_t index = 0;
+  for (frame_t f = 0; f < frames; f++)
+  {
+    float gain = scale * get_gain(action, position + f);
+    if (action->layout == MATRIX_LAYOUT)
+    {
+      for (frame_t e = 0; e < action->matrix->size; e++)
+      {
+        const struct matrixentry* entry = action->matrix->entries + e;
+        device_data[entry->output] += gain * entry->gain
+          * get_sample(action->format, buffer, index + entry->input);
+      }
+      index += channels;
+    }
+    else
+    {
+      for (frame_t c = 0; c < channels; c++)
+      {
+        device_data[action->mapping[c] - 1]
+          += gain * get_sample(action->format, buffer, index++);
+      }
+    }
+    device_data += device_channels;
+  }
+}
+
+// Envelope values are updated every few frames, which allows using the
+// loops with constant gain in between
+#define ENVELOPE_INTERVAL 16
+
+// Set parameters to the envelope values at the given position
+void update_envelopes(struct action* action, frame_t position)
+{
+  struct envelope** addr = &(action->envelopes);
+  while (*addr)
+  {
+    struct envelope* envelope = *addr;
+    const struct breakpoint* bp = envelope->breakpoints;
+    if (position < bp[0].frame)
+    {
+      // Not yet started, the current value is kept
+      addr = &(envelope->next);
+      continue;
+    }
+    if (position >= bp[envelope->size - 1].frame)
+    {
+      // The last value is kept, the envelope is not needed anymore
+      *(envelope->target) = bp[envelope->size - 1].value;
+      *addr = envelope->next;
+      continue;
+    }
+    while (bp[envelope->index + 1].frame <= position)
+    {
+      envelope->index++;
+    }
+    bp += envelope->index;
+    *(envelope->target) = bp[0].value + (bp[1].value - bp[0].value)
+      * (float)(position - bp[0].frame) / (float)(bp[1].frame - bp[0].frame);
+    addr = &(envelope->next);
+  }
+}
+
+// Number of frames (at most "frames") until the next envelope update
+frame_t envelope_chunk(frame_t position, frame_t frames)
+{
+  frame_t chunk = ENVELOPE_INTERVAL - position % ENVELOPE_INTERVAL;
+  return chunk < frames ? chunk : frames;
+}
+
+// Size of a single sample in bytes
+frame_t get_samplesize(enum sampleformat format)
+{
+  switch (format)
+  {
+    case INT16_FORMAT:
+      return sizeof(int16_t);
+    case INT32_FORMAT:
+      return sizeof(int32_t);
+    default:
+      return sizeof(float);
+  }
+}
+
+// Mix frames with constant gain, use the slower loop only while fading
+void play_frames(struct action* action, frame_t position
+  , const char* buffer, float* device_data, frame_t device_channels
+  , frame_t frames)
+{
+  frame_t fade_out_start = 0;
+  if (action->total_frames > action->fade_out)
+  {
+    fade_out_start = action->total_frames - action->fade_out;
+  }
+  while (frames)
+  {
+    frame_t chunk = frames;
+    if (action->envelopes)
+    {
+      update_envelopes(action, position);
+      chunk = envelope_chunk(position, frames);
+    }
+    bool ramp = true;
+    if (position < action->fade_in)
+    {
+      if (action->fade_in - position < chunk)
+      {
+        chunk = action->fade_in - position;
+      }
+    }
+    else if (position < fade_out_start)
+    {
+      ramp = false;
+      if (fade_out_start - position < chunk)
+      {
+        chunk = fade_out_start - position;
+      }
+    }
+    if (ramp)
+    {
+      mix_frames_ramp(action, position, buffer, device_data, device_channels
+        , chunk);
+    }
+    else
+    {
+      mix_frames(action, buffer, device_data, device_channels, chunk
+        , action->gain);
+    }
+    position += chunk;
+    buffer += chunk * action->channels * get_samplesize(action->format);
+    device_data += chunk * device_channels;
+    frames -= chunk;
+  }
+}
+
+// Sample rate conversion with a windowed sinc filter.  The filter
+// coefficients are pre-computed for a number of phases (i.e. fractional
+// positions), between those the results are interpolated linearly.
+
+// Adapt the resampling ratio to keep the fill level of the ring buffer
+// close to the target, using a PI controller on the smoothed fill level
+void adapt_step(struct action* action, frame_t fill, frame_t frames)
+{
+  struct resampler* r = &(action->resampler);
+  if (r->fill < 0.0)
+  {
+    r->fill = (double)fill;
+  }
+  double weight = (double)frames / r->fill_smoothing;
+  if (weight > 1.0)
+  {
+    weight = 1.0;
+  }
+  r->fill += ((double)fill - r->fill) * weight;
+  double error = r->fill - (double)r->fill_target;
+  double integral = r->integral + error * (double)frames;
+  double correction = r->kp * error + r->ki * integral;
+  if (correction > r->max_correction)
+  {
+    correction = r->max_correction;
+  }
+  else if (correction < -r->max_correction)
+  {
+    correction = -r->max_correction;
+  }
+  else
+  {
+    // The integral is only updated if not saturated (anti-windup)
+    r->integral = integral;
+  }
+  // Too many frames: playback consumes more, recording produces less
+  r->step = r->nominal_step * (1.0 + correction);
+}
+
+// Convert a number of device frames to frames of the action's buffer
+frame_t to_action_frames(const struct action* action, frame_t frames)
+{
+  const double step = action->resampler.step;
+  if (step == 0.0)
+  {
+    return frames;
+  }
+  if (action->type == RECORD_BUFFER || action->type == RECORD_RINGBUFFER)
+  {
+    return (frame_t)llround((double)frames / step);
+  }
+  return (frame_t)llround((double)frames * step);
+}
+
+// Interpolate one channel, "in" points to the first of the "taps" frames
+float interpolate(const struct resampler* r, const float* in, double frac)
+{
+  const double p = frac * (double)r->phases;
+  const frame_t phase = (frame_t)p;
+  const float weight = (float)(p - (double)phase);
+  const float* h0 = r->filter + phase * r->taps;
+  const float* h1 = h0 + r->taps;
+  float sum0 = 0.0f;
+  float sum1 = 0.0f;
+  for (frame_t k = 0; k < r->taps; k++)
+  {
+    sum0 += h0[k] * in[k];
+    sum1 += h1[k] * in[k];
+  }
+  return sum0 + weight * (sum1 - sum0);
+}
+
+// Store input frames [first, first + frames) of a playback action in the
+// resampler's buffer (as scaled float), return number of available frames.
+// Frames before the start or after the end (of a buffer) are zero.
+frame_t load_frames(struct action* action, int64_t first, frame_t frames)
+{
+  struct resampler* r = &(action->resampler);
+  const frame_t channels = action->channels;
+  const float scale = get_scale(action->format);
+  const char* block1 = NULL;
+  const char* block2 = NULL;
+  ring_buffer_size_t size1 = 0;
+  ring_buffer_size_t size2 = 0;
+  int64_t end = (int64_t)action->total_frames;
+  if (action->type == PLAY_RINGBUFFER)
+  {
+    // The read position of the ring buffer is at "buffer_start"
+    ring_buffer_size_t available = PaUtil_GetRingBufferReadRegions(
+        action->ringbuffer
+      , PaUtil_GetRingBufferReadAvailable(action->ringbuffer)
+      , (void**)&block1, &size1, (void**)&block2, &size2);
+    end = (int64_t)r->buffer_start + available;
+    if (first + (int64_t)frames > end)
+    {
+      frames = first < end ? (frame_t)(end - first) : 0;
+    }
+  }
+  const frame_t samplesize = get_samplesize(action->format);
+  for (frame_t f = 0; f < frames; f++)
+  {
+    const int64_t index = first + (int64_t)f;
+    const void* frame = NULL;
+    if (index < 0 || index >= end)
+    {
+      // Outside of the data
+    }
+    else if (action->type == PLAY_RINGBUFFER)
+    {
+      frame_t i = (frame_t)(index - (int64_t)r->buffer_start);
+      if (i < (frame_t)size1)
+      {
+        frame = block1 + i * channels * samplesize;
+      }
+      else
+      {
+        frame = block2 + (i - (frame_t)size1) * channels * samplesize;
+      }
+    }
+    else
+    {
+      frame = (const char*)action->buffer + (frame_t)index * channels
+        * samplesize;
+    }
+    for (frame_t c = 0; c < channels; c++)
+    {
+      r->buffer[c * frames + f] = frame
+        ? scale * get_sample(action->format, frame, c) : 0.0f;
+    }
+  }
+  return frames;
+}
+
+// Resampled playback, return false if the ring buffer has run empty
+bool play_resampled(struct action* action, float* device_data
+  , frame_t device_channels, frame_t frames)
+{
+  struct resampler* r = &(action->resampler);
+  const frame_t half = r->taps / 2;
+  while (frames && r->position < (double)action->total_frames)
+  {
+    const frame_t i0 = (frame_t)r->position;
+    // Number of output frames is limited by the size of the buffer ...
+    frame_t chunk = (frame_t)((double)(r->buffer_frames - r->taps) / r->step);
+    if (chunk > frames)
+    {
+      chunk = frames;
+    }
+    // ... and by the end of the action
+    double remaining = ((double)action->total_frames - r->position) / r->step;
+    if ((double)chunk > ceil(remaining))
+    {
+      chunk = (frame_t)ceil(remaining);
+    }
+    if (action->envelopes)
+    {
+      update_envelopes(action, i0);
+      if (chunk > ENVELOPE_INTERVAL)
+      {
+        chunk = ENVELOPE_INTERVAL;
+      }
+    }
+    const frame_t last
+      = (frame_t)(r->position + (double)(chunk - 1) * r->step);
+    const int64_t first = (int64_t)i0 + 1 - (int64_t)half;
+    const frame_t needed = last - i0 + r->taps;
+    const frame_t loaded = load_frames(action, first, needed);
+    bool empty = false;
+    if (loaded < needed)
+    {
+      // Only output frames with enough input frames after them are possible
+      empty = true;
+      int64_t limit = first + (int64_t)loaded - (int64_t)half;
+      if (limit <= (int64_t)i0)
+      {
+        return false;
+      }
+      double possible = ceil(((double)limit - r->position) / r->step);
+      if ((double)chunk > possible)
+      {
+        chunk = (frame_t)possible;
+      }
+    }
+    for (frame_t f = 0; f < chunk; f++)
+    {
+      const double position = r->position + (double)f * r->step;
+      const frame_t i = (frame_t)position;
+      const double frac = position - (double)i;
+      const float gain = get_gain(action, i);
+      const float* in = r->buffer + (i - i0);
+      if (action->layout == MATRIX_LAYOUT)
+      {
+        // Entries are sorted, each channel is interpolated only once
+        frame_t input = ULONG_MAX;
+        float sample = 0.0f;
+        for (frame_t e = 0; e < action->matrix->size; e++)
+        {
+          const struct matrixentry* entry = action->matrix->entries + e;
+          if (entry->input != input)
+          {
+            input = entry->input;
+            sample = gain * interpolate(r, in + input * loaded, frac);
+          }
+          device_data[entry->output] += entry->gain * sample;
+        }
+      }
+      else
+      {
+        for (frame_t c = 0; c < action->channels; c++)
+        {
+          device_data[action->mapping[c] - 1]
+            += gain * interpolate(r, in + c * loaded, frac);
+        }
+      }
+      device_data += device_channels;
+    }
+    frames -= chunk;
+    r->position += (double)chunk * r->step;
+    action->done_frames = (frame_t)r->position;
+    if (action->done_frames > action->total_frames)
+    {
+      action->done_frames = action->total_frames;
+    }
+    if (action->type == PLAY_RINGBUFFER)
+    {
+      // Keep the frames that are still needed for the next output frame
+      int64_t keep = (int64_t)action->done_frames + 1 - (int64_t)half;
+      if (keep > (int64_t)r->buffer_start)
+      {
+        PaUtil_AdvanceRingBufferReadIndex(action->ringbuffer
+          , (ring_buffer_size_t)(keep - (int64_t)r->buffer_start));
+        r->buffer_start = (frame_t)keep;
+      }
+    }
+    if (empty)
+    {
+      return false;
+    }
+  }
+  return true;
+}
+
+// Store a single sample (without any scaling)
+void store_sample(enum sampleformat format, void* buffer, frame_t index
+  , float value)
+{
+  switch (format)
+  {
+    case INT16_FORMAT:
+      ((int16_t*)buffer)[index] = float_to_int16(value);
+      break;
+    case INT32_FORMAT:
+      ((int32_t*)buffer)[index] = float_to_int32(value);
+      break;
+    default:
+      ((float*)buffer)[index] = value;
+  }
+}
+
+// Resampled recording, return false if the ring buffer is full.
+// The resampler's buffer keeps the device frames around the position of
+// the next output frame.  Device frames are counted from half the number
+// of taps (minus one) before the start of the action (those are zero).
+bool record_resampled(struct action* action, const float* device_data
+  , frame_t device_channels, frame_t frames)
+{
+  struct resampler* r = &(action->resampler);
+  const frame_t channels = action->channels;
+  const frame_t half = r->taps / 2;
+  const frame_t samplesize = get_samplesize(action->format);
+  while (frames)
+  {
+    frame_t chunk = r->buffer_frames - r->buffer_used;
+    if (chunk > frames)
+    {
+      chunk = frames;
+    }
+    for (frame_t f = 0; f < chunk; f++)
+    {
+      for (frame_t c = 0; c < channels; c++)
+      {
+        r->buffer[c * r->buffer_frames + r->buffer_used + f]
+          = device_data[action->mapping[c] - 1];
+      }
+      device_data += device_channels;
+    }
+    r->buffer_used += chunk;
+    frames -= chunk;
+
+    // Number of output frames that can be calculated from the buffer
+    const frame_t end = r->buffer_start + r->buffer_used;
+    frame_t outputs = 0;
+    if (end >= half + 1 && (double)(end - half) > r->position)
+    {
+      outputs = (frame_t)ceil(((double)(end - half) - r->position) / r->step);
+    }
+    if (outputs > action->total_frames - action->done_frames)
+    {
+      outputs = action->total_frames - action->done_frames;
+    }
+
+    char* block1 = NULL;
+    char* block2 = NULL;
+    ring_buffer_size_t size1 = 0;
+    ring_buffer_size_t size2 = 0;
+    bool full = false;
+    if (action->type == RECORD_RINGBUFFER)
+    {
+      ring_buffer_size_t available = PaUtil_GetRingBufferWriteRegions(
+          action->ringbuffer, (ring_buffer_size_t)outputs
+        , (void**)&block1, &size1, (void**)&block2, &size2);
+      if ((frame_t)available < outputs)
+      {
+        outputs = (frame_t)available;
+        full = true;
+      }
+    }
+    for (frame_t f = 0; f < outputs; f++)
+    {
+      const double position = r->position + (double)f * r->step;
+      const frame_t i = (frame_t)position;
+      const double frac = position - (double)i;
+      const float* in = r->buffer + (i + 1 - half - r->buffer_start);
+      void* out = NULL;
+      if (action->type == RECORD_RINGBUFFER)
+      {
+        out = f < (frame_t)size1
+          ? block1 + f * channels * samplesize
+          : block2 + (f - (frame_t)size1) * channels * samplesize;
+      }
+      else
+      {
+        out = (char*)action->buffer
+          + (action->done_frames + f) * channels * samplesize;
+      }
+      for (frame_t c = 0; c < channels; c++)
+      {
+        store_sample(action->format, out, c
+          , interpolate(r, in + c * r->buffer_frames, frac));
+      }
+    }
+    r->position += (double)outputs * r->step;
+    action->done_frames += outputs;
+    if (action->type == RECORD_RINGBUFFER)
+    {
+      PaUtil_AdvanceRingBufferWriteIndex(action->ringbuffer
+        , (ring_buffer_size_t)outputs);
+      if (full)
+      {
+        return false;
+      }
+    }
+    if (action->done_frames == action->total_frames)
+    {
+      return true;
+    }
+
+    // Discard the frames that are not needed anymore
+    frame_t keep = (frame_t)r->position + 1 - half;
+    if (keep > r->buffer_start)
+    {
+      frame_t discard = keep - r->buffer_start;
+      if (discard > r->buffer_used)
+      {
+        discard = r->buffer_used;
+      }
+      r->buffer_used -= discard;
+      r->buffer_start += discard;
+      for (frame_t c = 0; c < channels; c++)
+      {
+        float* channel = r->buffer + c * r->buffer_frames;
+        memmove(channel, channel + discard, r->buffer_used * sizeof(float));
+      }
+    }
+  }
+  return true;
+}
+
+// Change parameters of post-mix processing, keeping the current state
+void set_processing(struct outputchain* chain
+  , const struct processing* processing)
+{
+  if (processing->delay_line != chain->processing.delay_line)
+  {
+    chain->delay_position = 0;
+  }
+  for (frame_t i = chain->processing.biquad_count;
+       i < processing->biquad_count; i++)
+  {
+    chain->biquad_state[i][0] = 0.0f;
+    chain->biquad_state[i][1] = 0.0f;
+  }
+  chain->processing = *processing;
+}
+
+// Cascaded biquads, gain, delay and limiter applied to one output channel
+void process_output(struct outputchain* chain, float* data
+  , frame_t channels, frame_t frames)
+{
+  const struct processing* p = &(chain->processing);
+  for (frame_t i = 0; i < p->biquad_count; i++)
+  {
+    // Transposed direct form II
+    const struct biquad* bq = &(p->biquads[i]);
+    float z1 = chain->biquad_state[i][0];
+    float z2 = chain->biquad_state[i][1];
+    for (frame_t f = 0; f < frames; f++)
+    {
+      float x = data[f * channels];
+      float y = bq->b0 * x + z1;
+      z1 = bq->b1 * x - bq->a1 * y + z2;
+      z2 = bq->b2 * x - bq->a2 * y;
+      data[f * channels] = y;
+    }
+    chain->biquad_state[i][0] = z1;
+    chain->biquad_state[i][1] = z2;
+  }
+  if (p->delay_line)
+  {
+    const frame_t mask = p->delay_size - 1;
+    frame_t position = chain->delay_position;
+    for (frame_t f = 0; f < frames; f++)
+    {
+      p->delay_line[position] = data[f * channels];
+      data[f * channels] = p->delay_line[(position - p->delay) & mask];
+      position = (position + 1) & mask;
+    }
+    chain->delay_position = position;
+  }
+  if (p->gain != 1.0f)
+  {
+    for (frame_t f = 0; f < frames; f++)
+    {
+      data[f * channels] *= p->gain;
+    }
+  }
+  if (p->limit > 0.0f)
+  {
+    // Instant attack (i.e. no overshoot), exponential release
+    float gain = chain->limiter_gain;
+    for (frame_t f = 0; f < frames; f++)
+    {
+      float peak = fabsf(data[f * channels]);
+      float target = 1.0f;
+      if (peak > p->limit)
+      {
+        target = p->limit / peak;
+      }
+      if (target < gain)
+      {
+        gain = target;
+      }
+      else
+      {
+        gain = target + (gain - target) * p->release;
+      }
+      data[f * channels] *= gain;
+    }
+    chain->limiter_gain = gain;
+  }
+}
+
+// In-place radix-2 FFT of n complex values (interleaved real/imaginary).
+// The inverse transform is not scaled.
+void fft(float* data, frame_t n, const float* twiddle, bool inverse)
+{
+  for (frame_t i = 1, j = 0; i < n; i++)
+  {
+    // Bit-reversed counter
+    frame_t bit = n >> 1;
+    for (; j & bit; bit >>= 1)
+    {
+      j ^= bit;
+    }
+    j ^= bit;
+    if (i < j)
+    {
+      float re = data[2 * i];
+      float im = data[2 * i + 1];
+      data[2 * i] = data[2 * j];
+      data[2 * i + 1] = data[2 * j + 1];
+      data[2 * j] = re;
+      data[2 * j + 1] = im;
+    }
+  }
+  for (frame_t size = 2; size <= n; size <<= 1)
+  {
+    frame_t half = size / 2;
+    frame_t stride = n / size;
+    for (frame_t start = 0; start < n; start += size)
+    {
+      for (frame_t k = 0; k < half; k++)
+      {
+        float wr = twiddle[2 * k * stride];
+        float wi = twiddle[2 * k * stride + 1];
+        if (inverse)
+        {
+          wi = -wi;
+        }
+        float* a = data + 2 * (start + k);
+        float* b = data + 2 * (start + k + half);
+        float tr = b[0] * wr - b[1] * wi;
+        float ti = b[0] * wi + b[1] * wr;
+        b[0] = a[0] - tr;
+        b[1] = a[1] - ti;
+        a[0] += tr;
+        a[1] += ti;
+      }
+    }
+  }
+}
+
+// Transform impulse responses (frames x inputs x outputs) into "filters".
+// This is called from Python, before the action is sent to the callback.
+void prepare_convolution(struct convolution* conv, const float* ir
+  , frame_t frames)
 {
-  struct action* action = *addr;
-  *addr = action->next;  // Current action is removed from list
-  action->next = NULL;
-  ring_buffer_size_t written = PaUtil_WriteRingBuffer(state->result_q
-    , &action, 1);
-  if (written != 1)
+  const frame_t size = conv->partition_size;
+  const frame_t bins = size + 1;
+  // The scaling of the inverse FFT is applied here
+  const float scale = 1.0f / (float)(2 * size);
+  float* filter = conv->filters;
+  for (frame_t o = 0; o < conv->outputs; o++)
   {
-    // TODO: Stop callback! Unrecoverable error! Log error (in "state")?
-    printf("result queue is full\n");
+    for (frame_t i = 0; i < conv->inputs; i++)
+    {
+      for (frame_t p = 0; p < conv->partitions; p++)
+      {
+        memset(conv->scratch, 0, sizeof(float) * 4 * size);
+        for (frame_t f = 0; f < size && p * size + f < frames; f++)
+        {
+          conv->scratch[2 * f] = scale * ir[
+            ((p * size + f) * conv->inputs + i) * conv->outputs + o];
+        }
+        fft(conv->scratch, 2 * size, conv->twiddle, false);
+        memcpy(filter, conv->scratch, sizeof(float) * 2 * bins);
+        filter += 2 * bins;
+      }
+    }
   }
 }
 
-void get_stats(frame_t frameCount, PaStreamCallbackFlags flags
-  , struct stats* stats)
+// Convolve one block of input (or output) channels, the result is mixed
+// into (or replaces) the output channels
+void convolve(struct convolution* conv, const float* input, float* output
+  , const struct state* state, const frame_t* mapping)
 {
-  if (stats->blocks == 0)
+  const frame_t size = conv->partition_size;
+  const frame_t bins = size + 1;
+  const frame_t partitions = conv->partitions;
+  float* const scratch = conv->scratch;
+
+  const float* in_data = conv->post_mix ? output : input;
+  const frame_t in_channels = conv->post_mix
+    ? state->output_channels : state->input_channels;
+
+  conv->position = (conv->position + 1) % partitions;
+
+  for (frame_t i = 0; i < conv->inputs; i++)
   {
-    stats->min_blocksize = frameCount;
-    stats->max_blocksize = frameCount;
+    const frame_t channel = mapping[i] - 1;
+    float* previous = conv->previous + i * size;
+    for (frame_t f = 0; f < size; f++)
+    {
+      scratch[2 * f] = previous[f];
+      scratch[2 * f + 1] = 0.0f;
+      float sample = in_data[f * in_channels + channel];
+      scratch[2 * (size + f)] = sample;
+      scratch[2 * (size + f) + 1] = 0.0f;
+      previous[f] = sample;
+    }
+    fft(scratch, 2 * size, conv->twiddle, false);
+    memcpy(conv->spectra + 2 * bins * (i * partitions + conv->position)
+      , scratch, sizeof(float) * 2 * bins);
   }
-  else
+
+  const float* filter = conv->filters;
+  for (frame_t o = 0; o < conv->outputs; o++)
   {
-    if (frameCount < stats->min_blocksize)
+    // Only the non-negative frequencies are accumulated ...
+    memset(scratch, 0, sizeof(float) * 2 * bins);
+    for (frame_t i = 0; i < conv->inputs; i++)
     {
-      stats->min_blocksize = frameCount;
+      for (frame_t p = 0; p < partitions; p++)
+      {
+        frame_t slot = (conv->position + partitions - p) % partitions;
+        const float* spectrum
+          = conv->spectra + 2 * bins * (i * partitions + slot);
+        for (frame_t k = 0; k < bins; k++)
+        {
+          float xr = spectrum[2 * k];
+          float xi = spectrum[2 * k + 1];
+          float hr = filter[2 * k];
+          float hi = filter[2 * k + 1];
+          scratch[2 * k] += xr * hr - xi * hi;
+          scratch[2 * k + 1] += xr * hi + xi * hr;
+        }
+        filter += 2 * bins;
+      }
     }
-    if (frameCount > stats->max_blocksize)
+    // ... the others are their complex conjugates (because of real signals)
+    for (frame_t k = 1; k < size; k++)
     {
-      stats->max_blocksize = frameCount;
+      scratch[2 * (2 * size - k)] = scratch[2 * k];
+      scratch[2 * (2 * size - k) + 1] = -scratch[2 * k + 1];
     }
-  }
-  stats->blocks++;
-
-  if (flags & paInputUnderflow)  { stats->input_underflows++; }
-  if (flags & paInputOverflow)   { stats->input_overflows++; }
-  if (flags & paOutputUnderflow) { stats->output_underflows++; }
-  if (flags & paOutputOverflow)  { stats->output_overflows++; }
-}
+    fft(scratch, 2 * size, conv->twiddle, true);
 
-// CANCEL actions are inserted in the front, others in the back of the list.
-// Linked lists of actions are supported.
-void get_new_actions(struct state* state)
-{
-  struct action** last_action_addr = &(state->actions);
-  for (struct action* new_action = NULL
-      ; PaUtil_ReadRingBuffer(state->action_q, &new_action, 1)
-      ;)
-  {
-    do
+    // The first half is discarded (overlap-save)
+    const frame_t channel = mapping[conv->inputs + o] - 1;
+    for (frame_t f = 0; f < size; f++)
     {
-      struct action* next = new_action->next;
-      if (new_action->type == CANCEL)
+      float* target = output + f * state->output_channels + channel;
+      if (conv->post_mix)
       {
-        new_action->next = state->actions;
-        state->actions = new_action;
+        *target = scratch[2 * (size + f)];
       }
       else
       {
-        new_action->next = NULL;
-        while (*last_action_addr)
-        {
-          last_action_addr = &((*last_action_addr)->next);
-        }
-        *last_action_addr = new_action;
+        *target += scratch[2 * (size + f)];
       }
-      new_action = next;
     }
-    while (new_action);
   }
 }
 
-frame_t seconds2samples(PaTime time, double samplerate)
-{
-  return (frame_t) llround(time * samplerate);
-}
-
-PaTime get_relevant_time(const struct action* action
-  , const PaStreamCallbackTimeInfo* timeInfo)
+// Mix input channels (first half of mapping) into output channels
+void route_frames(struct action* action, const float* input, float* output
+  , const struct state* state, frame_t frames)
 {
-  enum actiontype type = action->type;
-  if (type == CANCEL)
-  {
-    CALLBACK_ASSERT(action->action);
-    type = action->action->type;
-  }
-
-  switch (type)
+  const frame_t channels = action->channels / 2;
+  const struct route* route = action->route;
+  const frame_t mask = route->delay_size - 1;
+  for (frame_t f = 0; f < frames; f++)
   {
-    case PLAY_BUFFER:
-    case PLAY_RINGBUFFER:
-      return timeInfo->outputBufferDacTime;
-    case RECORD_BUFFER:
-    case RECORD_RINGBUFFER:
-      return timeInfo->inputBufferAdcTime;
-    default:
-      return timeInfo->currentTime;
+    frame_t position = action->done_frames + f;
+    if (action->envelopes && (f == 0 || position % ENVELOPE_INTERVAL == 0))
+    {
+      update_envelopes(action, position);
+    }
+    float gain = get_gain(action, position);
+    for (frame_t c = 0; c < channels; c++)
+    {
+      float sample = input[f * state->input_channels + action->mapping[c] - 1];
+      if (route->delay_line)
+      {
+        route->delay_line[(position & mask) * channels + c] = sample;
+        sample = route->delay_line[
+          ((position - route->delay) & mask) * channels + c];
+      }
+      output[f * state->output_channels + action->mapping[channels + c] - 1]
+        += gain * sample;
+    }
   }
+  action->done_frames += frames;
 }
 
 int callback(const void* input, void* output, frame_t frameCount
   , const PaStreamCallbackTimeInfo* timeInfo, PaStreamCallbackFlags statusFlags
   , void* userData)
 {
+  double start_clock = get_clock();
   struct state* state = userData;
   CALLBACK_ASSERT(state);
 
   memset(output, 0, sizeof(float) * state->output_channels * frameCount);
 
   get_stats(frameCount, statusFlags, &(state->stats));
+  get_jitter(frameCount, timeInfo->currentTime, state);
+  update_drift(frameCount, timeInfo->currentTime, state);
+  if (statusFlags)
+  {
+    trace_event(XRUN, NULL, timeInfo->currentTime, statusFlags, state);
+  }
+
+  // Latest point in time where any action could start in the current block
+  PaTime horizon = timeInfo->currentTime;
+  if (timeInfo->inputBufferAdcTime > horizon)
+  {
+    horizon = timeInfo->inputBufferAdcTime;
+  }
+  if (timeInfo->outputBufferDacTime > horizon)
+  {
+    horizon = timeInfo->outputBufferDacTime;
+  }
+  horizon += (PaTime)frameCount / state->samplerate;
+
+  flush_finished_actions(state);
+
+  frame_t queued = (frame_t)PaUtil_GetRingBufferReadAvailable(state->action_q);
+  if (queued > state->max_action_q)
+  {
+    state->max_action_q = queued;
+  }
 
-  get_new_actions(state);
+  get_new_actions(state, horizon);
 
-  // TODO: store min/max available space in result_q?
-  // TODO: use worst case from before/after the "while" loop?
+  // The time of each loop iteration is assigned to the action type.
+  // To reduce the overhead, the clock is only read when the type changes.
+  double clock = get_clock();
+  int previous_type = -1;
 
   struct action** actionaddr = &(state->actions);
   while (*actionaddr)
   {
     struct action* const action = *actionaddr;
 
+    if ((int)action->type != previous_type)
+    {
+      double now = get_clock();
+      if (previous_type >= 0)
+      {
+        state->timing.action_time[previous_type] += now - clock;
+      }
+      clock = now;
+      previous_type = (int)action->type;
+    }
+    state->timing.actions++;
+
     PaTime time = get_relevant_time(action, timeInfo);
     frame_t offset = 0;
 
     // Check if the action is due to start in the current block
 
-    if (action->done_frames == 0)
+    if (!action->started)
     {
       // This action has not yet been "active"
 
@@ -174,16 +1549,37 @@ int callback(const void* input, void* output, frame_t frameCount
         if (action->actual_time == 0.0)
         {
           // allow_belated == False
+          trace_event(ACTION_DROPPED, action, time, 0, state);
           remove_action(actionaddr, state);
           continue;
         }
         action->actual_time = time;
       }
+      // NB: Resampled actions might not use any frames in this block
+      action->started = true;
+      if (is_playback_or_recording(action))
+      {
+        trace_event(ACTION_STARTED, action, action->actual_time, offset
+          , state);
+      }
     }
 
     // Handle CANCEL action
 
-    if (action->type == CANCEL)
+    if (action->type == CANCEL && is_pending(action->action, state))
+    {
+      // Pending actions are scheduled after the current block,
+      // so they can be removed before playback/recording begins
+
+      // TODO: save some more status information?
+      struct action* delinquent = action->action;
+      remove_pending(delinquent, state);
+      delinquent->total_frames = 0;
+      trace_event(ACTION_CANCELLED, delinquent
+        , time + (double)offset / state->samplerate, 0, state);
+      finish_action(delinquent, state);
+    }
+    else if (action->type == CANCEL)
     {
       // Since CANCEL actions are inserted in the beginning,
       // we need to search only the following list items
@@ -193,7 +1589,19 @@ int callback(const void* input, void* output, frame_t frameCount
         {
           struct action* delinquent = *i;
 
-          if (delinquent->done_frames == 0)
+          // Fading out is only done for playback
+          frame_t fade = 0;
+          if (delinquent->type == PLAY_BUFFER
+           || delinquent->type == PLAY_RINGBUFFER
+           || delinquent->type == ROUTE)
+          {
+            fade = action->fade_out;
+          }
+          const PaTime cancel_time
+            = time + (double)offset / state->samplerate;
+          bool cancelled = true;
+
+          if (!delinquent->started)
           {
             // delinquent is not yet playing/recording
 
@@ -208,6 +1616,8 @@ int callback(const void* input, void* output, frame_t frameCount
 
                 // TODO: save some more status information?
                 delinquent->total_frames = 0;
+                trace_event(ACTION_CANCELLED, delinquent, cancel_time, fade
+                  , state);
                 remove_action(i, state);
                 break;
               }
@@ -223,42 +1633,71 @@ int callback(const void* input, void* output, frame_t frameCount
               }
             }
 
+            frame_t remaining
+              = to_action_frames(delinquent, offset - delinquent_offset)
+              + fade;
             if (delinquent->total_frames == ULONG_MAX
-             || delinquent->total_frames + delinquent_offset > offset)
+             || delinquent->total_frames > remaining)
             {
-              delinquent->total_frames = offset - delinquent_offset;
+              delinquent->total_frames = remaining;
+              delinquent->fade_out = fade;
             }
             else
             {
               // TODO: stops on its own ... save some status information?
+              cancelled = false;
             }
           }
           else
           {
             CALLBACK_ASSERT(
                 delinquent->total_frames >= delinquent->done_frames);
-            if (delinquent->total_frames - delinquent->done_frames > offset)
+            frame_t remaining = to_action_frames(delinquent, offset) + fade;
+            if (delinquent->total_frames - delinquent->done_frames
+                > remaining)
             {
-              delinquent->total_frames = delinquent->done_frames + offset;
+              delinquent->total_frames = delinquent->done_frames + remaining;
+              delinquent->fade_out = fade;
             }
             else
             {
               // TODO: stops on its own ... save some status information?
+              cancelled = false;
             }
           }
           // TODO: save some informations to action->...?
+          if (cancelled)
+          {
+            trace_event(ACTION_CANCELLED, delinquent, cancel_time, fade
+              , state);
+          }
 
           break;  // We found the action, no need to keep searching
         }
       }
       // TODO: what if the action to cancel wasn't found?
+    }
 
+    if (action->type == CANCEL)
+    {
       remove_action(actionaddr, state);  // Remove the CANCEL action itself
       continue;
     }
 
     // Handle FETCH_AND_RESET_STATS action
 
+    if (action->type == FETCH_AND_RESET_STATS && action->action)
+    {
+      struct action* target = action->action;
+      action->stats = target->stats;
+      action->min_available = target->min_available;
+      action->min_available_time = target->min_available_time;
+      target->stats = EMPTY_STATS;
+      target->min_available = ULONG_MAX;
+      target->min_available_time = 0.0;
+      remove_action(actionaddr, state);
+      continue;
+    }
     if (action->type == FETCH_AND_RESET_STATS)
     {
       action->stats = state->stats;
@@ -267,6 +1706,100 @@ int callback(const void* input, void* output, frame_t frameCount
       continue;
     }
 
+    // Handle ENVELOPE action
+
+    if (action->type == ENVELOPE)
+    {
+      struct envelope* envelope = action->envelope;
+      CALLBACK_ASSERT(envelope->size >= 1);
+      envelope->next = envelope->action->envelopes;
+      envelope->action->envelopes = envelope;
+      remove_action(actionaddr, state);
+      continue;
+    }
+
+    // Handle SET_OUTPUT_PROCESSING action
+
+    if (action->type == SET_OUTPUT_PROCESSING)
+    {
+      CALLBACK_ASSERT(action->outputs);
+      // The output chains are only allocated once, this is a no-op after
+      // the first SET_OUTPUT_PROCESSING action
+      state->outputs = action->outputs;
+      for (frame_t c = 0; c < action->channels; c++)
+      {
+        CALLBACK_ASSERT(action->mapping[c] >= 1);
+        CALLBACK_ASSERT(action->mapping[c] <= state->output_channels);
+        set_processing(&(state->outputs[action->mapping[c] - 1])
+          , &(action->processing[c]));
+      }
+      remove_action(actionaddr, state);
+      continue;
+    }
+
+    // Handle CONVOLVE action
+
+    if (action->type == CONVOLVE)
+    {
+      struct convolution* conv = action->convolution;
+      CALLBACK_ASSERT(action->channels == conv->inputs + conv->outputs);
+      for (frame_t c = 0; c < action->channels; c++)
+      {
+        // The first "inputs" channels are input channels (unless post_mix)
+        CALLBACK_ASSERT(action->mapping[c] >= 1);
+        CALLBACK_ASSERT(c >= conv->inputs || conv->post_mix
+                     || action->mapping[c] <= state->input_channels);
+        CALLBACK_ASSERT((c < conv->inputs && !conv->post_mix)
+                     || action->mapping[c] <= state->output_channels);
+      }
+      if (action->done_frames == 0)
+      {
+        // Partitions are aligned with blocks
+        action->actual_time = time;
+      }
+      if (action->done_frames == action->total_frames)
+      {
+        // Cancelled
+        remove_action(actionaddr, state);
+        continue;
+      }
+      // Blocks of a different size (e.g. the last block of an offline
+      // stream) are not processed
+      bool matching = frameCount == conv->partition_size;
+      action->done_frames += frameCount;
+      if (action->done_frames > action->total_frames)
+      {
+        action->done_frames = action->total_frames;
+      }
+      if (conv->post_mix)
+      {
+        // This is done after all other actions, see below
+        actionaddr = &(action->next);
+        continue;
+      }
+      if (matching)
+      {
+        convolve(conv, input, output, state, action->mapping);
+      }
+      if (action->done_frames == action->total_frames)
+      {
+        remove_action(actionaddr, state);
+        continue;
+      }
+      actionaddr = &(action->next);
+      continue;
+    }
+
+    // Handle FETCH_AND_RESET_TIMING action
+
+    if (action->type == FETCH_AND_RESET_TIMING)
+    {
+      *(action->timing) = state->timing;
+      state->timing = EMPTY_TIMING;
+      remove_action(actionaddr, state);
+      continue;
+    }
+
     // Store buffer over-/underflow information etc.
 
     get_stats(frameCount, statusFlags, &(action->stats));
@@ -285,52 +1818,141 @@ int callback(const void* input, void* output, frame_t frameCount
       CALLBACK_ASSERT(frameCount > offset);
       frames = frameCount - offset;
     }
+    if (action->resampler.step > 0.0)
+    {
+      // The number of frames of the action is limited while resampling
+      CALLBACK_ASSERT(frameCount > offset);
+      frames = frameCount - offset;
+    }
+
+    if (action->type == ROUTE)
+    {
+      CALLBACK_ASSERT(action->channels / 2 * 2 == action->channels);
+      for (frame_t c = 0; c < action->channels / 2; c++)
+      {
+        CALLBACK_ASSERT(action->mapping[c] >= 1);
+        CALLBACK_ASSERT(action->mapping[c] <= state->input_channels);
+        CALLBACK_ASSERT(action->mapping[action->channels / 2 + c] >= 1);
+        CALLBACK_ASSERT(action->mapping[action->channels / 2 + c]
+            <= state->output_channels);
+      }
+      route_frames(action, (const float*)input + offset * state->input_channels
+        , (float*)output + offset * state->output_channels, state, frames);
+      if (action->done_frames == action->total_frames)
+      {
+        remove_action(actionaddr, state);
+        continue;
+      }
+      actionaddr = &(action->next);
+      continue;
+    }
 
     // Shove audio data around
 
     float* device_data = NULL;
+    frame_t device_channels = 0;
     if (action->type == PLAY_BUFFER || action->type == PLAY_RINGBUFFER)
     {
-      device_data = (float*)output + offset * state->output_channels;
+      device_data = (float*)output;
+      device_channels = state->output_channels;
     }
     else
     {
       CALLBACK_ASSERT(action->type == RECORD_BUFFER
                    || action->type == RECORD_RINGBUFFER);
-      device_data = (float*) input + offset * state->input_channels;
+      device_data = (float*) input;
+      device_channels = state->input_channels;
+    }
+    device_data += offset * device_channels;
+
+    // The channel mapping is checked once per block instead of per sample
+    CALLBACK_ASSERT(action->channels >= 1);
+    switch (action->layout)
+    {
+      case IDENTITY_LAYOUT:
+        CALLBACK_ASSERT(action->channels == device_channels);
+        break;
+      case CONTIGUOUS_LAYOUT:
+      case SINGLE_CHANNEL_LAYOUT:
+        CALLBACK_ASSERT(action->mapping[0] >= 1);
+        CALLBACK_ASSERT(
+            action->mapping[0] - 1 + action->channels <= device_channels);
+        break;
+      case MATRIX_LAYOUT:
+        CALLBACK_ASSERT(action->type == PLAY_BUFFER
+                     || action->type == PLAY_RINGBUFFER);
+        for (frame_t e = 0; e < action->matrix->size; e++)
+        {
+          CALLBACK_ASSERT(action->matrix->entries[e].input < action->channels);
+          CALLBACK_ASSERT(action->matrix->entries[e].output < device_channels);
+        }
+        break;
+      default:
+        CALLBACK_ASSERT(action->layout == GENERIC_LAYOUT);
+        for (frame_t c = 0; c < action->channels; c++)
+        {
+          CALLBACK_ASSERT(action->mapping[c] >= 1);
+          CALLBACK_ASSERT(action->mapping[c] <= device_channels);
+        }
+    }
+
+    if (action->type == PLAY_RINGBUFFER || action->type == RECORD_RINGBUFFER)
+    {
+      frame_t available = (frame_t)(action->type == PLAY_RINGBUFFER
+        ? PaUtil_GetRingBufferReadAvailable(action->ringbuffer)
+        : PaUtil_GetRingBufferWriteAvailable(action->ringbuffer));
+      if (available < action->min_available)
+      {
+        action->min_available = available;
+        action->min_available_time = time;
+      }
+      if (action->resampler.fill_target)
+      {
+        adapt_step(action, action->type == PLAY_RINGBUFFER ? available
+          : (frame_t)action->ringbuffer->bufferSize - available, frames);
+      }
+    }
+    else
+    {
+      CALLBACK_ASSERT(!action->resampler.fill_target);
     }
 
-    if (action->type == PLAY_BUFFER || action->type == RECORD_BUFFER)
+    if (action->resampler.step > 0.0)
+    {
+      bool ok = true;
+      if (action->type == PLAY_BUFFER || action->type == PLAY_RINGBUFFER)
+      {
+        ok = play_resampled(action, device_data, device_channels, frames);
+      }
+      else
+      {
+        ok = record_resampled(action, device_data, device_channels, frames);
+      }
+      if (!ok)
+      {
+        // Ring buffer is empty or full
+        trace_event(action->type == PLAY_RINGBUFFER
+            ? RINGBUFFER_EMPTY : RINGBUFFER_FULL
+          , action, get_action_time(action, state), action->done_frames
+          , state);
+        remove_action(actionaddr, state);
+        continue;
+      }
+    }
+    else if (action->type == PLAY_BUFFER || action->type == RECORD_BUFFER)
     {
-      float* buffer = action->buffer + action->done_frames * action->channels;
+      char* buffer = (char*)action->buffer + action->done_frames
+        * action->channels * get_samplesize(action->format);
       action->done_frames += frames;
       if (action->type == PLAY_BUFFER)
       {
-        while (frames--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->output_channels);
-            device_data[action->mapping[c] - 1] += *buffer++;
-          }
-          device_data += state->output_channels;
-        }
+        play_frames(action, action->done_frames - frames, buffer
+          , device_data, device_channels, frames);
       }
       else
       {
         CALLBACK_ASSERT(action->type == RECORD_BUFFER);
-
-        while (frames--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->input_channels);
-            *buffer++ = device_data[action->mapping[c] - 1];
-          }
-          device_data += state->input_channels;
-        }
+        copy_frames(action, device_data, device_channels, buffer, frames);
       }
     }
     else
@@ -338,8 +1960,8 @@ int callback(const void* input, void* output, frame_t frameCount
       CALLBACK_ASSERT(action->type ==   PLAY_RINGBUFFER
                    || action->type == RECORD_RINGBUFFER);
 
-      float* block1 = NULL;
-      float* block2 = NULL;
+      char* block1 = NULL;
+      char* block2 = NULL;
       ring_buffer_size_t size1 = 0;
       ring_buffer_size_t size2 = 0;
       ring_buffer_size_t totalsize = 0;
@@ -351,23 +1973,13 @@ int callback(const void* input, void* output, frame_t frameCount
           , (void**)&block1, &size1, (void**)&block2, &size2);
         CALLBACK_ASSERT(!totalsize || size1);
 
-        while (size1--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->output_channels);
-            device_data[action->mapping[c] - 1] += *block1++;
-          }
-          device_data += state->output_channels;
-        }
-        while (size2--)
+        play_frames(action, action->done_frames, block1
+          , device_data, device_channels, (frame_t)size1);
+        if (size2)
         {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            device_data[action->mapping[c] - 1] += *block2++;
-          }
-          device_data += state->output_channels;
+          device_data += size1 * device_channels;
+          play_frames(action, action->done_frames + (frame_t)size1, block2
+            , device_data, device_channels, (frame_t)size2);
         }
         action->done_frames += (frame_t)totalsize;
         PaUtil_AdvanceRingBufferReadIndex(action->ringbuffer, totalsize);
@@ -381,23 +1993,13 @@ int callback(const void* input, void* output, frame_t frameCount
           , (void**)&block1, &size1, (void**)&block2, &size2);
         CALLBACK_ASSERT(!totalsize || size1);
 
-        while (size1--)
-        {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            CALLBACK_ASSERT(action->mapping[c] >= 1);
-            CALLBACK_ASSERT(action->mapping[c] <= state->input_channels);
-            *block1++ = device_data[action->mapping[c] - 1];
-          }
-          device_data += state->input_channels;
-        }
-        while (size2--)
+        copy_frames(action, device_data, device_channels, block1
+          , (frame_t)size1);
+        if (size2)
         {
-          for (frame_t c = 0; c < action->channels; c++)
-          {
-            *block2++ = device_data[action->mapping[c] - 1];
-          }
-          device_data += state->input_channels;
+          device_data += size1 * device_channels;
+          copy_frames(action, device_data, device_channels, block2
+            , (frame_t)size2);
         }
         action->done_frames += (frame_t)totalsize;
         PaUtil_AdvanceRingBufferWriteIndex(action->ringbuffer, totalsize);
@@ -406,6 +2008,10 @@ int callback(const void* input, void* output, frame_t frameCount
       if (totalsize < (ring_buffer_size_t)frames)
       {
         // Ring buffer is empty or full
+        trace_event(action->type == PLAY_RINGBUFFER
+            ? RINGBUFFER_EMPTY : RINGBUFFER_FULL
+          , action, get_action_time(action, state), action->done_frames
+          , state);
         remove_action(actionaddr, state);
         continue;
       }
@@ -420,5 +2026,58 @@ int callback(const void* input, void* output, frame_t frameCount
     }
     actionaddr = &(action->next);
   }
+
+  // Convolution of the mixed output signal
+
+  double now = get_clock();
+  if (previous_type >= 0)
+  {
+    state->timing.action_time[previous_type] += now - clock;
+  }
+  clock = now;
+  previous_type = -1;
+
+  actionaddr = &(state->actions);
+  while (*actionaddr)
+  {
+    struct action* const action = *actionaddr;
+    if (action->type == CONVOLVE && action->convolution->post_mix
+        && action->done_frames > 0)
+    {
+      if (frameCount == action->convolution->partition_size)
+      {
+        convolve(action->convolution, input, output, state, action->mapping);
+      }
+      previous_type = CONVOLVE;
+      if (action->done_frames == action->total_frames)
+      {
+        remove_action(actionaddr, state);
+        continue;
+      }
+    }
+    actionaddr = &(action->next);
+  }
+
+  if (previous_type >= 0)
+  {
+    state->timing.action_time[previous_type] += get_clock() - clock;
+  }
+
+  if (state->outputs)
+  {
+    for (frame_t c = 0; c < state->output_channels; c++)
+    {
+      process_output(&(state->outputs[c]), (float*)output + c
+        , state->output_channels, frameCount);
+    }
+  }
+
+  if (state->notify)
+  {
+    notify_finished(state);
+  }
+
+  double end_clock = get_clock();
+  get_timing(frameCount, end_clock - start_clock, state);
   return paContinue;
 }
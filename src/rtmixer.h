@@ -15,6 +15,30 @@ enum actiontype
   RECORD_RINGBUFFER,
   CANCEL,
   FETCH_AND_RESET_STATS,
+  FETCH_AND_RESET_TIMING,
+  SET_OUTPUT_PROCESSING,
+  CONVOLVE,
+  ROUTE,
+  ENVELOPE,
+};
+
+#define ACTION_TYPES 11  // Number of items in enum actiontype
+#define LOAD_HISTOGRAM_SIZE 11  // 10% steps, last bin: 100% and more
+
+enum layout
+{
+  GENERIC_LAYOUT,  // Arbitrary channel mapping
+  CONTIGUOUS_LAYOUT,  // Mapping to a contiguous range of channels
+  IDENTITY_LAYOUT,  // Mapping to all channels, in order
+  SINGLE_CHANNEL_LAYOUT,  // Mapping of a single channel
+  MATRIX_LAYOUT,  // Sparse gain matrix instead of mapping (only playback)
+};
+
+enum sampleformat
+{
+  FLOAT32_FORMAT,
+  INT16_FORMAT,
+  INT32_FORMAT,
 };
 
 struct stats
@@ -28,25 +52,189 @@ struct stats
   frame_t output_overflows;
 };
 
+enum eventtype
+{
+  ACTION_STARTED,  // value: offset (in frames) within the block
+  ACTION_FINISHED,  // value: done_frames
+  ACTION_CANCELLED,  // value: number of frames used for fading out
+  ACTION_DROPPED,  // Belated action with allow_belated=False
+  RINGBUFFER_EMPTY,  // value: done_frames
+  RINGBUFFER_FULL,  // value: done_frames
+  XRUN,  // value: statusFlags
+};
+
+struct event
+{
+  enum eventtype type;
+  enum actiontype action_type;
+  const struct action* action;  // Only used for identification
+  PaTime time;  // Stream time when the event happened
+  frame_t value;
+};
+
+struct timing
+{
+  frame_t blocks;  // Number of measured callback invocations
+  frame_t actions;  // Number of processed actions (summed over all blocks)
+  double total_time;  // Execution time of the callback (in seconds)
+  double max_time;  // Longest execution time of a single block
+  double max_load;  // Maximum ratio of execution time and block duration
+  frame_t load_histogram[LOAD_HISTOGRAM_SIZE];  // Blocks per load range
+  double action_time[ACTION_TYPES];  // Execution time per action type
+  frame_t jitter_blocks;  // Number of blocks used for jitter measurement
+  double total_jitter;  // Sum of absolute deviations of currentTime ...
+  double max_jitter;  // ... from the value expected from the previous block
+};
+
+struct resampler
+{
+  double step;  // Input frames per output frame (0.0: no resampling)
+  double position;  // Position of the next output frame (in input frames)
+  const float* filter;  // (phases + 1) rows of "taps" coefficients
+  frame_t taps;  // Even number of filter coefficients per phase
+  frame_t phases;
+  float* buffer;  // Input frames (planar: one channel after the other)
+  frame_t buffer_frames;  // Capacity of "buffer" (per channel)
+  frame_t buffer_start;  // Index of the first input frame in "buffer"
+  frame_t buffer_used;  // Number of valid frames in "buffer" (per channel)
+  // Adaptive ratio for ring buffers (only used if "fill_target" is non-zero):
+  double nominal_step;
+  frame_t fill_target;  // Desired number of frames in the ring buffer
+  double fill;  // Smoothed fill level (negative: not yet measured)
+  double fill_smoothing;  // Time constant of the smoothing (in frames)
+  double kp, ki;  // Gains of the PI controller
+  double integral;  // Accumulated error (in frames times frames)
+  double max_correction;  // Maximum relative deviation from nominal_step
+};
+
+#define MAX_BIQUADS 8
+
+struct biquad
+{
+  float b0, b1, b2, a1, a2;  // Normalized coefficients (a0 = 1)
+};
+
+struct processing
+{
+  frame_t biquad_count;
+  struct biquad biquads[MAX_BIQUADS];
+  float gain;
+  frame_t delay;  // Number of frames (must be less than delay_size)
+  float* delay_line;  // NULL if there is no delay
+  frame_t delay_size;  // Power of 2
+  float limit;  // Maximum absolute value (0.0: no limiter)
+  float release;  // Limiter release coefficient (per frame)
+};
+
+// Post-mix processing of one output channel
+struct outputchain
+{
+  struct processing processing;  // Parameters
+  float biquad_state[MAX_BIQUADS][2];
+  frame_t delay_position;
+  float limiter_gain;
+};
+
+// Uniformly partitioned overlap-save convolution
+struct convolution
+{
+  frame_t partition_size;  // Block size, power of 2 (FFT size is twice that)
+  frame_t partitions;  // Number of partitions of the impulse responses
+  frame_t inputs;
+  frame_t outputs;
+  bool post_mix;  // Convolve output channels (instead of input channels)
+  const float* twiddle;  // Complex FFT factors (half the FFT size)
+  float* filters;  // Spectra of IR partitions [output][input][partition]
+  float* spectra;  // Spectra of past input blocks [input][partition]
+  frame_t position;  // Partition index of the newest input block
+  float* previous;  // Previous input block [input][frame]
+  float* scratch;  // Complex values (FFT size)
+};
+
+struct matrixentry
+{
+  frame_t input;  // Channel of the buffer (0-based)
+  frame_t output;  // Channel of the device (0-based)
+  float gain;
+};
+
+struct matrix
+{
+  frame_t size;  // Number of entries
+  struct matrixentry* entries;  // Sorted by input channel
+};
+
+struct breakpoint
+{
+  frame_t frame;  // Position in the action (in frames of its buffer)
+  float value;
+};
+
+// Segment of a breakpoint envelope (linear interpolation in between)
+struct envelope
+{
+  struct action* const action;  // Action whose parameter is changed
+  float* const target;  // Gain of the action (or of one of its matrix entries)
+  const struct breakpoint* const breakpoints;  // Sorted by frame
+  const frame_t size;  // Number of breakpoints
+  frame_t index;  // Current breakpoint
+  struct envelope* next;  // Next envelope of the same action
+};
+
+struct route
+{
+  frame_t delay;  // Number of frames
+  float* delay_line;  // [frame][channel] (NULL if there is no delay)
+  frame_t delay_size;  // Power of 2, larger than "delay"
+};
+
 struct action
 {
   const enum actiontype type;
   const PaTime requested_time;
   PaTime actual_time;  // Set != 0.0 to allow belated actions
   struct action* next;  // Used to create singly linked list of actions
+  struct action* prev;  // Used in the heap of pending actions
+  struct action* child;  // Used in the heap of pending actions
   union {
-    float* const buffer;
+    void* const buffer;
     struct PaUtilRingBuffer* const ringbuffer;
-    struct action* const action;  // Used in CANCEL
+    struct action* const action;  // Used in CANCEL and FETCH_AND_RESET_STATS
+    struct timing* const timing;  // Used in FETCH_AND_RESET_TIMING
+    // Used in SET_OUTPUT_PROCESSING (one per channel):
+    const struct processing* const processing;
+    struct convolution* const convolution;  // Used in CONVOLVE
+    const struct route* const route;  // Used in ROUTE
+    struct envelope* const envelope;  // Used in ENVELOPE
   };
   frame_t total_frames;
   frame_t done_frames;
+  bool started;  // Set by the callback when the action becomes active
+  float gain;  // Only used for playback and ROUTE
+  frame_t fade_in;  // Number of frames (only used for playback and ROUTE)
+  frame_t fade_out;  // Number of frames (in CANCEL: fade-out when stopping)
   struct stats stats;
-  // TODO: ringbuffer usage: store smallest available write/read size?
+  frame_t min_available;  // Smallest readable/writable frames in ring buffer
+  PaTime min_available_time;  // Time of the block with min_available
+  struct resampler resampler;  // Input: buffer (playback) or device (rec.)
+  const struct matrix* matrix;  // Used with MATRIX_LAYOUT
+  struct envelope* envelopes;  // List of active envelopes (or NULL)
+  // Used in SET_OUTPUT_PROCESSING (one per output channel of the stream):
+  struct outputchain* const outputs;
+  enum layout layout;  // Selected in Python, based on the channel mapping
+  enum sampleformat format;  // Of buffer/ringbuffer, the device uses float
   const frame_t channels;  // Size of the following array
   const frame_t mapping[];  // "flexible array member"
 };
 
+// Delay-locked loop for estimating the actual duration of a frame
+struct drift
+{
+  double bandwidth;  // In Hertz
+  double period;  // Duration of one frame (0.0: not yet estimated)
+  PaTime predicted;  // Expected currentTime of the next block
+};
+
 struct state
 {
   const frame_t input_channels;
@@ -54,11 +242,32 @@ struct state
   double samplerate;
   struct PaUtilRingBuffer* const action_q;  // Queue for incoming commands
   struct PaUtilRingBuffer* const result_q;  // Q for results and cmd disposal
-  struct action* actions;  // Singly linked list of actions
+  struct action* actions;  // Singly linked list of active actions
+  struct action** actions_tail;  // Address of "next" of the last action
+  struct action* pending;  // Heap of actions that are not yet due
+  struct action* finished;  // Actions that didn't fit into result_q (yet)
   struct stats stats;
-  // TODO: result_q usage?
+  // High-water marks (number of entries):
+  frame_t max_action_q;  // Actions waiting in action_q at start of a block
+  frame_t max_result_q;  // Actions in result_q after writing
+  frame_t max_finished;  // Actions held back because result_q was full
+  frame_t finished_count;  // Current number of actions in "finished"
+  struct timing timing;
+  PaTime last_time;  // currentTime of the previous block (for jitter)
+  frame_t last_frames;  // frameCount of the previous block (for jitter)
+  struct PaUtilRingBuffer* trace;  // Optional queue of events (or NULL)
+  frame_t lost_events;  // Events that didn't fit into "trace"
+  struct outputchain* outputs;  // One per output channel (or NULL)
+  struct drift drift;
+  int notify_fd;  // Pipe for waking up waiting threads (-1: none)
+  bool notify;  // Actions were written to result_q in the current block
 };
 
 int callback(const void* input, void* output, frame_t frameCount
   , const PaStreamCallbackTimeInfo* timeInfo, PaStreamCallbackFlags statusFlags
   , void* userData);
+
+void fft(float* data, frame_t n, const float* twiddle, bool inverse);
+
+void prepare_convolution(struct convolution* conv, const float* ir
+  , frame_t frames);
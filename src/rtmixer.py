@@ -5,6 +5,23 @@ https://python-rtmixer.readthedocs.io/
 """
 __version__ = '0.1.7'
 
+import asyncio as _asyncio
+import collections as _collections
+import contextlib as _contextlib
+import ctypes as _ctypes
+import ctypes.util as _ctypes_util
+import math as _math
+import mmap as _mmap
+import numbers as _numbers
+import os as _os
+import select as _select
+import struct as _struct
+import sys as _sys
+import threading as _threading
+import time as _time
+import warnings as _warnings
+import weakref as _weakref
+
 import sounddevice as _sd
 from pa_ringbuffer import init as _init_ringbuffer
 from _rtmixer import ffi as _ffi, lib as _lib
@@ -17,12 +34,48 @@ for _k, _v in vars(_lib).items():
         globals()[_k] = _v
 
 
-class _Base(_sd._StreamBase):
-    """Base class for Mixer et al."""
+class _ActionPool(object):
+    """Pre-allocated memory for actions with up to *max_channels*.
 
-    def __init__(self, kind, qsize=16, **kwargs):
-        callback = _ffi.addressof(_lib, 'callback')
+    Memory is allocated in slabs of *slabsize* actions.  An action is
+    returned to the pool when the returned object is garbage collected.
+
+    """
+
+    def __init__(self, max_channels, slabsize=64):
+        itemsize = (_ffi.sizeof('struct action')
+                    + max_channels * _ffi.sizeof('frame_t'))
+        alignment = _ffi.alignof('struct action')
+        self._itemsize = -(-itemsize // alignment) * alignment
+        self._max_channels = max_channels
+        self._slabsize = slabsize
+        self._slabs = []
+        self._free = []
+        # NB: Bound methods of the list are used to avoid function calls
+        self._allocator = _ffi.new_allocator(self._alloc, self._free.append)
+
+    def new(self, init):
+        """Create action from dictionary, like ffi.new() would do."""
+        if init.get('channels', 0) > self._max_channels:
+            return _ffi.new('struct action*', init)
+        return self._allocator('struct action*', init)
+
+    def _alloc(self, size):
+        if not self._free:
+            slab = _ffi.new('char[]', self._itemsize * self._slabsize)
+            self._slabs.append(slab)
+            self._free.extend(
+                slab + i * self._itemsize for i in range(self._slabsize))
+        return self._free.pop()
 
+
+class _Base(object):
+    """Base class for Mixer et al."""
+
+    def __init__(self, qsize=None, lock_memory=False, max_actions=1024,
+                 trace_size=0):
+        if qsize is None:
+            qsize = 1 << max(max_actions - 1, 1).bit_length()
         self._action_q = RingBuffer(_ffi.sizeof('struct action*'), qsize)
         self._result_q = RingBuffer(_ffi.sizeof('struct action*'), qsize)
         self._state = _ffi.new('struct state*', dict(
@@ -32,20 +85,102 @@ class _Base(_sd._StreamBase):
             action_q=self._action_q._ptr,
             result_q=self._result_q._ptr,
             actions=_ffi.NULL,
+            finished=_ffi.NULL,
+            drift=dict(bandwidth=_DRIFT_BANDWIDTH),
+            notify_fd=-1,
         ))
-        _sd._StreamBase.__init__(
-            self, kind=kind, dtype='float32',
-            callback=callback, userdata=self._state, **kwargs)
-        self._state.samplerate = self.samplerate
-
+        self._trace = None
+        if trace_size:
+            self._trace = RingBuffer(_ffi.sizeof('struct event'), trace_size)
+            self._state.trace = self._trace._ptr
         self._actions = {}
+        self._samples = {}
         self._temp_action_ptr = _ffi.new('struct action**')
+        self._temp_result_ptr = _ffi.new('struct action**')
+        self._action_pool = None
+        self._batch = None
+        # Actions may be sent from the file streaming thread
+        self._action_q_lock = _threading.Lock()
+        self._file_streamer = None
+        self._page_locker = None
+        self._outputs = None
+        self._delay_lines = {}
+        self._memory_locker = None
+        if lock_memory:
+            self._memory_locker = _MemoryLocker()
+            for obj in self._state, self._action_q, self._result_q:
+                self._memory_locker.lock(None, obj)
+            if self._trace is not None:
+                self._memory_locker.lock(None, self._trace)
+            # NB: Memory is unlocked when the stream is closed or collected
+            _weakref.finalize(self, self._memory_locker.unlock_all)
+        # The result queue may be drained by the notification thread
+        self._result_lock = _threading.Condition(_threading.Lock())
+        self._waiters = 0
+        self._futures = []
+        self._wakeup = _threading.Event()
+        self._notification_thread = None
 
     @property
     def actions(self):
         """The set of active "actions"."""
         self._drain_result_q()
-        return self._actions.keys()
+        with self._result_lock:
+            return set(self._actions)
+
+    @property
+    def queue_highwater(self):
+        """High-water marks of the action queue and the result queue.
+
+        This is a dictionary with the following keys:
+
+        ``'action_q'``
+            Maximum number of queue entries waiting to be received by
+            the callback (at the beginning of an audio block).
+        ``'result_q'``
+            Maximum number of finished actions waiting in the result
+            queue to be disposed of.
+        ``'held_back'``
+            Maximum number of finished actions that had to be held
+            back by the callback because the result queue was full.
+            They are written to the result queue as soon as there is
+            room, so nothing gets lost, but disposing of them is
+            delayed.
+
+        By default, both queues are big enough to hold *max_actions*
+        (default: 1024) entries, their size can also be set directly
+        with *qsize* (which must be a power of 2).
+
+        """
+        state = self._state
+        return {
+            'action_q': state.max_action_q,
+            'result_q': state.max_result_q,
+            'held_back': state.max_finished,
+        }
+
+    @property
+    def locked_memory(self):
+        """Number of bytes locked in memory (with ``lock_memory=True``).
+
+        With ``lock_memory=True``, the memory used by the audio
+        callback (the internal state, the action queues, the actions
+        and the buffers/ring buffers used by them) is locked in memory
+        (see :manpage:`mlock(2)`) in order to avoid page faults in the
+        callback.  The memory of actions and their buffers is unlocked
+        when the action is finished.  If memory cannot be locked (e.g.
+        because ``RLIMIT_MEMLOCK`` is too low), a `RuntimeWarning` is
+        issued (once) and the stream works without locking.  Memory
+        of a `MappedFile` is locked separately (and not counted here).
+        All memory is unlocked when the stream is closed (or garbage
+        collected).
+
+        """
+        if self._memory_locker is None:
+            return 0
+        self._drain_result_q()
+        with self._result_lock:
+            return self._memory_locker.locked_bytes()
 
     @property
     def stats(self):
@@ -59,7 +194,7 @@ class _Base(_sd._StreamBase):
             raise RuntimeError('Accessing .stats on an active stream')
         return _ffi.new('struct stats*', self._state.stats)
 
-    def cancel(self, action, time=0, allow_belated=True):
+    def cancel(self, action, time=0, allow_belated=True, fade_out=None):
         """Initiate stopping a running action.
 
         This creates another action that is sent to the callback in
@@ -69,46 +204,248 @@ class _Base(_sd._StreamBase):
         stopped.  Use `wait()` (on either one of the two actions) to
         wait until it's done.
 
+        Playback actions are faded out over *fade_out* frames, starting
+        at the given *time*.  By default, the *fade_out* value of the
+        playback action is used.  Recordings are always stopped at
+        *time*.
+
         """
-        cancel_action = _ffi.new('struct action*', dict(
+        if fade_out is None:
+            fade_out = action.fade_out
+        cancel_action = self._new_action(dict(
             type=CANCEL,
             actual_time=-1.0 if allow_belated else 0.0,
             requested_time=time,
             action=action,
+            fade_out=fade_out,
         ))
-        self._enqueue(cancel_action)
+        # The cancelled action must not be re-used while cancel_action exists
+        if (self._file_streamer is not None
+                and self._file_streamer.defer(action, cancel_action)):
+            # The action of play_file() has not been sent yet
+            self._register_action(cancel_action, action)
+            return cancel_action
+        self._enqueue(cancel_action, keep_alive=action)
         return cancel_action
 
-    def fetch_and_reset_stats(self, time=0, allow_belated=True):
+    def fetch_and_reset_stats(self, time=0, allow_belated=True, action=None):
         """Fetch and reset over-/underflow statistics of the stream.
 
         The statistics will be available in the ``stats`` field of the
         returned action.
 
+        If an *action* is given, its statistics are fetched (and reset)
+        instead of the ones of the whole stream.  For actions created
+        with `play_ringbuffer()` and `record_ringbuffer()`, this also
+        fetches (and resets) the ``min_available`` field, which holds
+        the smallest number of frames that were available for reading
+        (or writing, respectively) from the ring buffer at the
+        beginning of any block, and ``min_available_time``, which is
+        the time of the block where this happened.  These watermarks
+        can be used to find the smallest safe ring buffer size (and
+        amount of pre-filling).  The values are also available in the
+        *action* itself once it is finished.
+
         """
-        action = _ffi.new('struct action*', dict(
+        fetch_action = self._new_action(dict(
             type=FETCH_AND_RESET_STATS,
             actual_time=-1.0 if allow_belated else 0.0,
             requested_time=time,
+            action=_ffi.NULL if action is None else action,
         ))
-        self._enqueue(action)
+        self._enqueue(fetch_action, keep_alive=action)
+        return fetch_action
+
+    def fetch_and_reset_timing(self, time=0, allow_belated=True):
+        """Fetch and reset timing measurements of the audio callback.
+
+        The measurements will be available in the ``timing`` field of
+        the returned action (*after* it is finished):
+
+        .. literalinclude:: ../src/rtmixer.h
+           :language: c
+           :start-at: struct timing
+           :end-at: }
+
+        The execution time of the callback is measured for each block.
+        The "load" is the execution time divided by the duration of
+        the block, ``load_histogram`` counts the blocks with a load
+        of 0 to 10%, 10 to 20% etc., the last bin counts the blocks
+        that took at least as long as their duration.  ``action_time``
+        is indexed by action type (e.g. ``PLAY_BUFFER``).  The jitter
+        is the difference between the ``currentTime`` of a block and
+        the expected value, based on the previous block.
+
+        """
+        timing = _ffi.new('struct timing*')
+        action = self._new_action(dict(
+            type=FETCH_AND_RESET_TIMING,
+            actual_time=-1.0 if allow_belated else 0.0,
+            requested_time=time,
+            timing=timing,
+        ))
+        self._enqueue(action, keep_alive=timing)
         return action
 
-    def wait(self, action=None, sleeptime=10):
-        """Wait for *action* to be finished.
+    def read_trace(self):
+        """Get events that were traced by the audio callback.
+
+        Tracing has to be enabled by passing the maximum number of
+        queued events as *trace_size* (a power of 2) when creating the
+        stream.  The callback writes the events into a queue without
+        locking, this method removes them from the queue and returns
+        them as a list of dictionaries with the following keys:
+
+        ``'type'``
+            One of ``'ACTION_STARTED'``, ``'ACTION_FINISHED'``,
+            ``'ACTION_CANCELLED'``, ``'ACTION_DROPPED'`` (belated
+            action with ``allow_belated=False``),
+            ``'RINGBUFFER_EMPTY'``, ``'RINGBUFFER_FULL'`` and ``'XRUN'``.
+        ``'time'``
+            The stream time of the event.
+        ``'action'``
+            An integer that identifies the action (``0`` for
+            ``'XRUN'``).  Note that the memory of finished actions
+            is re-used, so the same value can appear for different
+            (subsequent) actions.
+        ``'action_type'``
+            The type of the action, e.g. ``'PLAY_BUFFER'``.
+        ``'value'``
+            The offset (in frames) within the block for
+            ``'ACTION_STARTED'``, the number of frames used for
+            fading out for ``'ACTION_CANCELLED'``, the status flags
+            (see `sounddevice.CallbackFlags`) for ``'XRUN'``, and the
+            number of processed frames otherwise.
+
+        Events that didn't fit into the queue are lost, their number
+        is available as `lost_events`.  The events can be converted
+        to a timeline with `chrome_trace()`.
+
+        """
+        if self._trace is None:
+            raise RuntimeError('Tracing is not enabled (see trace_size)')
+        data = self._trace.read()
+        events = _ffi.from_buffer('struct event[]', data)
+        event_types = _get_enum_names('enum eventtype')
+        action_types = _get_enum_names('enum actiontype')
+        return [{
+            'type': event_types[event.type],
+            'time': event.time,
+            'action': int(_ffi.cast('uintptr_t', event.action)),
+            'action_type': (action_types[event.action_type]
+                            if event.action else None),
+            'value': event.value,
+        } for event in events]
 
-        Between repeatedly checking if the action is finished, this
-        waits for *sleeptime* milliseconds.
+    @property
+    def lost_events(self):
+        """Number of events that didn't fit into the trace queue.
+
+        See `read_trace()`.
+
+        """
+        return self._state.lost_events
+
+    @property
+    def estimated_samplerate(self):
+        """Sampling rate of the device, measured with the stream's clock.
+
+        This is estimated from the ``currentTime`` and the number of
+        frames of each block passed to the callback (using a
+        delay-locked loop).  The deviation from the nominal `samplerate`
+        is the drift between the clocks of the audio device and the
+        one used for the time stamps (typically the system clock).
+        The value is ``None`` before the first block.
+
+        """
+        period = self._state.drift.period
+        if not period:
+            return None
+        return 1 / period
+
+    def wait(self, action=None, sleeptime=None, *, timeout=None):
+        """Wait for *action* to be finished.
 
         If no *action* is given, this waits for all actions.
 
+        This blocks until the action is finished or until *timeout*
+        (in seconds) has passed.  Returns ``True`` if the action is
+        finished, ``False`` on timeout.
+
+        The result queue is checked by a helper thread (which is
+        started on first use), as long as someone is waiting.  The
+        audio callback wakes up this thread (via a pipe) whenever
+        actions are finished.  On Windows, the result queue is checked
+        in intervals of one millisecond instead.
+
+        *sleeptime* is deprecated and ignored.
+
         """
+        if sleeptime is not None:
+            _warnings.warn(
+                'sleeptime is deprecated and ignored, use timeout=...',
+                DeprecationWarning, stacklevel=2)
+        with self._result_lock:
+            self._waiters += 1
+            self._wakeup.set()
+        self._start_notification_thread()
+        try:
+            with self._result_lock:
+                return self._result_lock.wait_for(
+                    lambda: self._is_finished(action), timeout)
+        finally:
+            with self._result_lock:
+                self._waiters -= 1
+                if not self._waiters and not self._futures:
+                    self._wakeup.clear()
+
+    async def wait_async(self, action=None):
+        """Wait for *action* to be finished, to be used with `asyncio`.
+
+        This is a coroutine, which can be awaited in a running event
+        loop (e.g. ``await mixer.wait_async(action)``) without blocking
+        the loop.  See `wait()` for details.
+        To use a timeout, use `asyncio.wait_for()`.
+
+        """
+        loop = _asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._result_lock:
+            if self._is_finished(action):
+                return
+            self._futures.append((action, future))
+            self._wakeup.set()
+        self._start_notification_thread()
+        try:
+            await future
+        finally:
+            with self._result_lock:
+                try:
+                    self._futures.remove((action, future))
+                except ValueError:
+                    pass  # Already removed by _drain_result_q()
+                if not self._waiters and not self._futures:
+                    self._wakeup.clear()
+
+    def _is_finished(self, action):
         if action is None:
-            while self.actions:
-                _sd.sleep(sleeptime)
-        else:
-            while action in self.actions:
-                _sd.sleep(sleeptime)
+            return not self._actions
+        return action not in self._actions
+
+    def _start_notification_thread(self):
+        if self._notification_thread is None:
+            pipe = None
+            if _sys.platform != 'win32':
+                # NB: The pipe is closed by the thread
+                pipe = _os.pipe()
+                for fd in pipe:
+                    _os.set_blocking(fd, False)
+                self._state.notify_fd = pipe[1]
+            self._notification_thread = _threading.Thread(
+                target=_notification_loop,
+                args=(_weakref.ref(self), self._wakeup, pipe),
+                name='rtmixer notifications', daemon=True)
+            self._notification_thread.start()
 
     def _check_channels(self, channels, kind):
         """Check if number of channels or mapping was given."""
@@ -124,157 +461,1673 @@ class _Base(_sd._StreamBase):
             raise ValueError('Channel numbers start with 1')
         return channels, mapping
 
+    def _check_dtype(self, dtype, buffer=None):
+        """Get sample format and sample size of buffer/ring buffer."""
+        if dtype is None:
+            dtype = getattr(buffer, 'dtype', 'float32')
+        dtype = str(dtype)
+        if dtype == 'float32':
+            return FLOAT32_FORMAT, 4
+        if dtype == 'int16':
+            return INT16_FORMAT, 2
+        if dtype == 'int32':
+            return INT32_FORMAT, 4
+        raise ValueError('Unsupported dtype: {!r}'.format(dtype))
+
+    def _select_layout(self, action):
+        """Select specialized loop in the callback based on channel map."""
+        if action.matrix:
+            return MATRIX_LAYOUT
+        if action.type in (PLAY_BUFFER, PLAY_RINGBUFFER):
+            device_channels = self._state.output_channels
+        else:
+            device_channels = self._state.input_channels
+        channels = action.channels
+        first = action.mapping[0]
+        if list(action.mapping[0:channels]) != list(
+                range(first, first + channels)):
+            return GENERIC_LAYOUT
+        if first == 1 and channels == device_channels:
+            return IDENTITY_LAYOUT
+        if channels == 1:
+            return SINGLE_CHANNEL_LAYOUT
+        return CONTIGUOUS_LAYOUT
+
+    def _new_matrix(self, matrix, channels):
+        """Create sparse gain matrix.
+
+        Returns ``(channels, mapping, matrix, memory)``, where *memory*
+        has to be kept alive while the action is running.  If no
+        *matrix* is given, *channels* is checked as usual and ``NULL``
+        is returned as matrix.
+
+        """
+        if matrix is None:
+            channels, mapping = self._check_channels(channels, 'output')
+            return channels, mapping, _ffi.NULL, ()
+        if not isinstance(channels, _numbers.Integral):
+            raise TypeError('With a gain matrix, channels must be a number')
+        channels = int(channels)
+        output_channels = _sd._split(self.channels)[1]
+        entries = []
+        if isinstance(matrix, dict):
+            for (input, output), gain in sorted(matrix.items()):
+                if not 1 <= input <= channels:
+                    raise ValueError('Invalid input channel in gain matrix')
+                if not 1 <= output <= output_channels:
+                    raise ValueError('Invalid output channel in gain matrix')
+                entries.append(
+                    dict(input=input - 1, output=output - 1, gain=gain))
+        else:
+            if len(matrix) != channels:
+                raise ValueError('Gain matrix must have one row per channel')
+            for input, row in enumerate(matrix):
+                if len(row) > output_channels:
+                    raise ValueError('Gain matrix has too many columns')
+                entries.extend(
+                    dict(input=input, output=output, gain=gain)
+                    for output, gain in enumerate(row) if gain)
+        entries = _ffi.new('struct matrixentry[]', entries)
+        matrix = _ffi.new('struct matrix*', dict(
+            size=len(entries),
+            entries=entries,
+        ))
+        # NB: The mapping isn't used with MATRIX_LAYOUT
+        return channels, (0,) * channels, matrix, (matrix, entries)
+
+    def _new_resampler(self, samplerate, quality, channels, kind,
+                       fill_target=None, ringbuffer=None):
+        """Get initializer for struct resampler and memory to keep alive.
+
+        *kind* is ``'output'`` for playback (resampling from
+        *samplerate* to the stream's sampling rate) and ``'input'``
+        for recording (resampling to *samplerate*).
+
+        If *fill_target* is given, the ratio is adapted to keep the
+        fill level of *ringbuffer* at this number of frames (even if
+        the sampling rates are the same).
+
+        """
+        if fill_target is not None:
+            if not 0 < fill_target < ringbuffer._ptr.bufferSize:
+                raise ValueError(
+                    'fill_target must be between 0 and the ring buffer size')
+            samplerate = samplerate or self.samplerate
+        elif not samplerate or samplerate == self.samplerate:
+            return {}, ()
+        try:
+            taps, rolloff, beta = _RESAMPLING_QUALITY[quality]
+        except KeyError:
+            raise ValueError('Invalid quality: {!r}'.format(quality))
+        if kind == 'output':
+            step = samplerate / self.samplerate
+        else:
+            step = self.samplerate / samplerate
+        # Fixed cost: the number of taps is independent of the ratio
+        cutoff = rolloff * min(1.0, 1.0 / step)
+        key = taps, cutoff, beta
+        if key not in _resampling_filters:
+            _resampling_filters[key] = _make_resampling_filter(
+                taps, _RESAMPLING_PHASES, cutoff, beta)
+        filter = _resampling_filters[key]
+        # Chunks of at least 256 output/input frames fit into the buffer
+        if kind == 'output':
+            buffer_frames = taps + int(256 * step) + 2
+        else:
+            buffer_frames = taps + 256
+        buffer = _ffi.new('float[]', channels * buffer_frames)
+        init = dict(
+            step=step,
+            filter=filter,
+            taps=taps,
+            phases=_RESAMPLING_PHASES,
+            buffer=buffer,
+            buffer_frames=buffer_frames,
+        )
+        if kind == 'input':
+            # Zeros before the start (see record_resampled() in C)
+            init.update(position=taps // 2 - 1, buffer_used=taps // 2 - 1)
+        if fill_target is not None:
+            # PI controller for a critically damped loop, the ring buffer
+            # is filled (or drained) with a rate of "samplerate"
+            omega = 2 * _math.pi * _ADAPTIVE_BANDWIDTH
+            init.update(
+                nominal_step=step,
+                fill_target=fill_target,
+                fill=-1.0,
+                fill_smoothing=_ADAPTIVE_SMOOTHING * self.samplerate,
+                kp=2 * omega / samplerate,
+                ki=omega**2 / samplerate / self.samplerate,
+                max_correction=_ADAPTIVE_MAX_CORRECTION,
+            )
+        return init, (filter, buffer)
+
+    def _new_action(self, init):
+        """Create a new action, using pre-allocated memory if possible."""
+        if self._action_pool is None:
+            # NB: This is done lazily because the number of channels is
+            #     only known after the stream has been created.
+            self._action_pool = _ActionPool(max(
+                self._state.input_channels, self._state.output_channels))
+        return self._action_pool.new(init)
+
+    @_contextlib.contextmanager
+    def batch(self):
+        """Context manager for submitting multiple commands at once.
+
+        All commands (e.g. `play_buffer()`) that are issued within
+        the ``with`` statement are collected and sent to the callback
+        as a single linked list of actions at the end of the ``with``
+        statement.  This uses only one entry in the action queue, and
+        all actions are guaranteed to be received by the callback in
+        the same audio block.  The commands still return their
+        actions as usual, which can be used after the ``with``
+        statement.
+
+        If an exception is raised within the ``with`` statement, none
+        of the collected actions are sent to the callback.
+
+        Nested ``with`` statements are allowed, the actions are sent
+        at the end of the outermost one.
+
+        """
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        except BaseException:
+            for action, _ in self._batch:
+                self._release_sample(action)
+            self._batch = None
+            raise
+        batch, self._batch = self._batch, None
+        if not batch:
+            return
+        for (action, _), (next_action, _) in zip(batch, batch[1:]):
+            action.next = next_action
+        try:
+            self._write_actions(batch)
+        except RuntimeError:
+            for action, _ in batch:
+                action.next = _ffi.NULL
+            raise
+
     def _enqueue(self, action, keep_alive=None):
+        if action.channels:
+            action.layout = self._select_layout(action)
+        if self._batch is not None:
+            self._batch.append((action, keep_alive))
+            return
+        self._write_actions([(action, keep_alive)])
+
+    def _write_actions(self, actions):
+        """Write list of (action, keep_alive) pairs as one queue entry.
+
+        The actions have to be linked already.
+
+        """
         self._drain_result_q()
-        self._temp_action_ptr[0] = action
-        ret = self._action_q.write(self._temp_action_ptr)
+        # NB: Actions are added before they can be received by the
+        #     callback, because the notification thread may remove them.
+        for action, keep_alive in actions:
+            self._register_action(action, keep_alive)
+        try:
+            self._send_actions(actions[0][0])
+        except RuntimeError:
+            with self._result_lock:
+                for action, _ in actions:
+                    del self._actions[action]
+                    if self._memory_locker is not None:
+                        self._memory_locker.unlock(action)
+                    self._release_sample(action)
+            raise
+
+    def _register_action(self, action, keep_alive):
+        """Add *action* to the active actions (before sending it)."""
+        with self._result_lock:
+            assert action not in self._actions
+            self._actions[action] = keep_alive
+            if self._memory_locker is not None:
+                self._memory_locker.lock(action, action, keep_alive)
+
+    def _send_actions(self, action):
+        """Write (a linked list of) already registered action(s)."""
+        with self._action_q_lock:
+            self._temp_action_ptr[0] = action
+            ret = self._action_q.write(self._temp_action_ptr)
         if ret != 1:
             raise RuntimeError('Action queue is full')
-        assert action not in self._actions
-        self._actions[action] = keep_alive
+
+    def _release_sample(self, action):
+        """Allow eviction of the sample played by *action* (if any)."""
+        entry = self._samples.pop(action, None)
+        if entry is not None:
+            bank, sample = entry
+            bank._release(sample)
 
     def _drain_result_q(self):
-        """Get actions from the result queue and discard them."""
-        while self._result_q.readinto(self._temp_action_ptr):
+        """Get actions from the result queue and discard them.
+
+        Waiting threads and coroutines are notified.
+
+        """
+        with self._result_lock:
+            drained = False
+            while self._result_q.readinto(self._temp_result_ptr):
+                action = self._temp_result_ptr[0]
+                try:
+                    del self._actions[action]
+                except KeyError:
+                    assert False
+                if self._memory_locker is not None:
+                    self._memory_locker.unlock(action)
+                self._release_sample(action)
+                drained = True
+            if not drained:
+                return
+            self._result_lock.notify_all()
+            for action, future in self._futures[:]:
+                if self._is_finished(action):
+                    self._futures.remove((action, future))
+                    future.get_loop().call_soon_threadsafe(
+                        _set_future_result, future)
+
+
+def _get_enum_names(ctype):
+    return _ffi.typeof(ctype).elements
+
+
+def chrome_trace(events, pid=0):
+    """Convert events from `Mixer.read_trace()` to Chrome's trace format.
+
+    The returned dictionary can be stored as JSON file (with
+    `json.dump`) and viewed in a trace viewer like
+    https://ui.perfetto.dev/ or ``chrome://tracing``.
+    Each playback/recording action is shown as a separate (async)
+    slice, all other events are shown as instant events.  *pid* can be
+    used to distinguish the events from different streams.
+
+    """
+    trace = []
+    started = set()
+    for event in events:
+        common = {
+            'ts': event['time'] * 1e6,
+            'pid': pid,
+            'tid': 0,
+        }
+        action_id = '0x{:x}'.format(event['action'])
+        if event['type'] == 'ACTION_STARTED':
+            started.add(action_id)
+            trace.append(dict(
+                common, ph='b', cat='action', id=action_id,
+                name=event['action_type'], args={'offset': event['value']}))
+        elif event['type'] == 'ACTION_FINISHED' and action_id in started:
+            started.remove(action_id)
+            trace.append(dict(
+                common, ph='e', cat='action', id=action_id,
+                name=event['action_type'], args={'frames': event['value']}))
+        elif event['type'] == 'XRUN':
+            trace.append(dict(
+                common, ph='i', s='g', name='XRUN',
+                args={'flags': str(_sd.CallbackFlags(event['value']))}))
+        else:
+            trace.append(dict(
+                common, ph='i', s='t', name=event['type'], args={
+                    'action': action_id,
+                    'action_type': event['action_type'],
+                    'value': event['value'],
+                }))
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def _set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _notification_loop(mixer_ref, wakeup, pipe):
+    """Drain result queue of mixer (as long as someone is waiting).
+
+    If a *pipe* is given, this blocks until the callback writes to it,
+    otherwise the result queue is polled.
+
+    """
+    fd = pipe and pipe[0]
+    while True:
+        if not wakeup.wait(timeout=1):
+            if mixer_ref() is None:
+                break
+            continue
+        mixer = mixer_ref()
+        if mixer is None:
+            break
+        if fd is not None:
+            # Before draining, to not miss any notification
             try:
-                del self._actions[self._temp_action_ptr[0]]
-            except KeyError:
-                assert False
+                _os.read(fd, 4096)
+            except BlockingIOError:
+                pass
+        mixer._drain_result_q()
+        del mixer
+        if fd is None:
+            _time.sleep(0.001)
+        else:
+            # With timeout, in order to notice when the mixer is gone
+            _select.select([fd], [], [], 1)
+    if pipe is not None:
+        for fd in pipe:
+            _os.close(fd)
 
 
-class Mixer(_Base):
-    """PortAudio output stream for realtime mixing.
+class _HelperThread(object):
+    """Base class for doing periodic work on a daemon thread.
 
-    Takes the same keyword arguments as `sounddevice.OutputStream`,
-    except *callback* (a callback function implemented in C is used
-    internally) and *dtype* (which is always ``'float32'``).
+    The thread is started by _start() (which has to be called while
+    holding _cond) and it stops as soon as _idle() returns True.
+    _work() is called repeatedly, it returns the time (in seconds)
+    until it should be called again, _cond can be notified to call it
+    earlier.
 
-    Uses default values from `sounddevice.default` (except *dtype*,
-    which is always ``'float32'``).
+    """
 
-    Has the same methods and attributes as `sounddevice.OutputStream`
-    (except :meth:`~sounddevice.Stream.write` and
-    :attr:`~sounddevice.Stream.write_available`), plus the following:
+    def __init__(self):
+        self._cond = _threading.Condition(_threading.Lock())
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = _threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._idle():
+                    self._thread = None
+                    return
+            timeout = self._work()
+            with self._cond:
+                self._cond.wait(max(timeout, 0.001))
+
+
+class _FileStreamer(_HelperThread):
+    """Decode sound files into ring buffers on a background thread."""
+
+    def __init__(self, mixer):
+        _HelperThread.__init__(self)
+        self._mixer = mixer
+        self._entries = []
+
+    def add(self, f, ringbuffer, action):
+        with self._cond:
+            self._entries.append(_FileStreamerEntry(f, ringbuffer, action))
+            self._start()
+
+    def defer(self, action, other):
+        """Send *other* together with *action*, if not sent yet.
+
+        Returns ``False`` if *action* has already been sent (or if it
+        is not streamed at all).
+
+        """
+        with self._cond:
+            for entry in self._entries:
+                if entry.action == action and not entry.sent:
+                    entry.deferred.append(other)
+                    return True
+        return False
+
+    def _idle(self):
+        return not self._entries
+
+    def _work(self):
+        mixer = self._mixer
+        blocktime = (mixer.blocksize or 1024) / mixer.samplerate
+        with self._cond:
+            entries = list(self._entries)
+        timeout = 1.0
+        for entry in entries:
+            if entry.sent and entry.action not in mixer.actions:
+                self._remove(entry)
+                continue
+            if not entry.eof:
+                entry.fill()
+            if not entry.sent:
+                try:
+                    self._send(entry)
+                except RuntimeError:
+                    # Action queue is full, try again later
+                    timeout = min(timeout, blocktime)
+                    continue
+            if entry.eof:
+                # The action stops when the ring buffer is empty
+                self._remove(entry)
+                continue
+            missing = entry.threshold - entry.ringbuffer.write_available
+            timeout = min(timeout, max(missing, 0) / mixer.samplerate)
+        return timeout
+
+    def _send(self, entry):
+        """Send action of *entry* (linked with deferred actions)."""
+        with self._cond:
+            actions = [entry.action] + entry.deferred
+            for action, next_action in zip(actions, actions[1:]):
+                action.next = next_action
+            self._mixer._send_actions(entry.action)
+            entry.sent = True
+
+    def _remove(self, entry):
+        entry.file.close()
+        with self._cond:
+            self._entries.remove(entry)
+
+
+class _FileStreamerEntry(object):
+
+    __slots__ = ('file', 'ringbuffer', 'action', 'threshold', 'sent', 'eof',
+                 'deferred')
+
+    def __init__(self, f, ringbuffer, action):
+        self.file = f
+        self.ringbuffer = ringbuffer
+        self.action = action
+        size = ringbuffer.write_available
+        self.threshold = size // 2
+        self.sent = False
+        self.eof = False
+        # Actions (e.g. CANCEL) to be sent together with the action
+        self.deferred = []
+
+    def fill(self):
+        """Decode as much as fits into the free space of the ring buffer.
+
+        The data is decoded directly into the memory of the ring buffer.
+
+        """
+        rb = self.ringbuffer
+        _, buf1, buf2 = rb.get_write_buffers(rb.write_available)
+        written = 0
+        for buf in buf1, buf2:
+            if not buf:
+                continue
+            frames = self.file.buffer_read_into(buf, dtype='float32')
+            written += frames
+            if frames < len(buf) // rb.elementsize:
+                self.eof = True
+                break
+        rb.advance_write_index(written)
+
+
+# Number of taps, rolloff (relative to Nyquist) and Kaiser window beta
+_RESAMPLING_QUALITY = {
+    'low': (8, 0.8, 5.0),
+    'medium': (16, 0.9, 7.0),
+    'high': (32, 0.95, 9.0),
+}
+_RESAMPLING_PHASES = 256
+_resampling_filters = {}
+
+# Adaptive resampling of ring buffers: bandwidth of the control loop (in
+# Hertz), time constant of the fill level smoothing (in seconds) and
+# maximum relative deviation of the resampling ratio
+_ADAPTIVE_BANDWIDTH = 0.01
+_ADAPTIVE_SMOOTHING = 1.0
+_ADAPTIVE_MAX_CORRECTION = 0.001
+
+# Bandwidth of the delay-locked loop for estimating the clock drift (in Hertz)
+_DRIFT_BANDWIDTH = 0.1
+
+
+def _make_resampling_filter(taps, phases, cutoff, beta):
+    """Create table of windowed sinc coefficients for struct resampler.
+
+    Each of the ``phases + 1`` rows contains the coefficients for the
+    ``taps`` input frames around a fractional position (from 0 to 1),
+    it is normalized to unity gain at DC.
 
     """
+    half = taps // 2
 
-    def __init__(self, **kwargs):
-        _Base.__init__(self, kind='output', **kwargs)
-        self._state.output_channels = self.channels
+    def bessel_i0(x):
+        total = term = 1.0
+        k = 1
+        while term > 1e-12 * total:
+            term *= (x / (2 * k)) ** 2
+            total += term
+            k += 1
+        return total
+
+    def kernel(x):
+        arg = max(1.0 - (x / half) ** 2, 0.0)
+        window = bessel_i0(beta * _math.sqrt(arg)) / bessel_i0(beta)
+        x *= cutoff
+        sinc = _math.sin(_math.pi * x) / (_math.pi * x) if x else 1.0
+        return cutoff * sinc * window
+
+    table = []
+    for phase in range(phases + 1):
+        frac = phase / phases
+        row = [kernel(k - (half - 1) - frac) for k in range(taps)]
+        total = sum(row)
+        table.extend(value / total for value in row)
+    return _ffi.new('float[]', table)
+
+
+def _get_libc():
+    """Return C library for mlock() and friends (or None on Windows)."""
+    global _libc
+    if _libc is None and _sys.platform != 'win32':
+        _libc = _ctypes.CDLL(_ctypes_util.find_library('c'), use_errno=True)
+        for name in 'mlock', 'munlock', 'madvise':
+            func = getattr(_libc, name)
+            func.argtypes = _ctypes.c_void_p, _ctypes.c_size_t
+            func.restype = _ctypes.c_int
+        _libc.madvise.argtypes += _ctypes.c_int,
+    return _libc
+
+
+_libc = None
+_MADV_WILLNEED = 3
+
+
+def _mlock(address, size):
+    """Lock memory range, return False if not possible."""
+    libc = _get_libc()
+    return libc is not None and size > 0 and libc.mlock(address, size) == 0
+
+
+def _munlock(address, size):
+    libc = _get_libc()
+    if libc is not None and size > 0:
+        libc.munlock(address, size)
+
+
+def _prefault(address, size):
+    """Ask the OS to read memory range ahead (page-aligned address)."""
+    libc = _get_libc()
+    if libc is not None and size > 0:
+        libc.madvise(address, size, _MADV_WILLNEED)
+
+
+class _MemoryLocker(object):
+    """Keep track of memory regions locked for a stream.
+
+    Regions are registered per key (an action or None for the memory of
+    the stream itself).  Since mlock() works on whole pages and locks
+    are not counted, pages are only unlocked if they are not part of
+    any other registered region.
+
+    """
+
+    def __init__(self):
+        self._regions = {}
+        self._warned = False
+
+    def lock(self, key, *objects):
+        regions = self._regions.setdefault(key, [])
+        for obj in objects:
+            for address, size in _get_memory_regions(obj):
+                start = address - address % _mmap.PAGESIZE
+                stop = address + size
+                stop += -stop % _mmap.PAGESIZE
+                if _mlock(start, stop - start):
+                    regions.append((start, stop))
+                elif not self._warned:
+                    self._warned = True
+                    _warnings.warn(
+                        'Unable to lock memory (RLIMIT_MEMLOCK too low?), '
+                        'continuing without locking', RuntimeWarning)
+        if not regions:
+            del self._regions[key]
+
+    def unlock(self, key):
+        regions = self._regions.pop(key, ())
+        others = [other for other_regions in self._regions.values()
+                  for other in other_regions]
+        for start, stop in regions:
+            for other_start, other_stop in sorted(others):
+                if other_stop <= start or other_start >= stop:
+                    continue
+                _munlock(start, max(other_start - start, 0))
+                start = max(start, other_stop)
+            _munlock(start, stop - start)
+
+    def unlock_all(self):
+        for start, stop in sorted(
+                region for regions in self._regions.values()
+                for region in regions):
+            _munlock(start, stop - start)
+        self._regions.clear()
+
+    def locked_bytes(self):
+        """Return size of union of all locked regions."""
+        total = 0
+        end = 0
+        for start, stop in sorted(
+                region for regions in self._regions.values()
+                for region in regions):
+            start = max(start, end)
+            if stop > start:
+                total += stop - start
+                end = stop
+        return total
+
+
+def _get_memory_regions(obj):
+    """Yield (address, size) of memory used by the callback via obj."""
+    if isinstance(obj, tuple):
+        for item in obj:
+            yield from _get_memory_regions(item)
+    elif isinstance(obj, RingBuffer):
+        yield from _get_memory_regions(obj._ptr)
+        yield from _get_memory_regions(obj._data)
+    elif isinstance(obj, _ffi.CData):
+        ctype = _ffi.typeof(obj)
+        if ctype.kind == 'array':
+            size = _ffi.sizeof(obj)
+        elif ctype.kind == 'pointer' and ctype.item.kind == 'struct':
+            if ctype.item.cname == 'struct action':
+                size = _ffi.offsetof('struct action', 'mapping') + \
+                    obj.channels * _ffi.sizeof('frame_t')
+            else:
+                size = _ffi.sizeof(ctype.item)
+        else:
+            return
+        yield int(_ffi.cast('uintptr_t', obj)), size
+    # Other objects (e.g. the memory-mapped buffer of a MappedFile,
+    # which has its own locking) are ignored.
+
+
+class _LockedWindow(object):
+    """Range of pages locked ahead of the playhead of an action.
+
+    This is (part of) the keep_alive object of the action, the remaining
+    pages are unlocked when this is garbage-collected.  The memory of
+    the buffer is locked here (only partially), therefore it is not
+    visible to _MemoryLocker.
+
+    """
+
+    def __init__(self, buffer, action, framesize, frames):
+        pagesize = _mmap.PAGESIZE
+        self.buffer = buffer  # Keep alive
+        self.action = action
+        self.framesize = framesize
+        self.address = int(_ffi.cast('uintptr_t', buffer))
+        self.end = self.address + len(buffer)
+        self.size = frames * framesize
+        # Page-aligned locked range [start, stop)
+        start = self.address - self.address % pagesize
+        self.range = [start, start]
+        _weakref.finalize(self, _unlock_range, self.range)
+        self.update()
+
+    def update(self):
+        """Move window to current playhead."""
+        pagesize = _mmap.PAGESIZE
+        position = self.address + self.action.done_frames * self.framesize
+        start = position - position % pagesize
+        stop = min(position + self.size, self.end)
+        stop += -stop % pagesize
+        old_start, old_stop = self.range
+        if start > old_start:
+            _munlock(old_start, min(start, old_stop) - old_start)
+            old_start = start
+        old_stop = max(old_stop, start)
+        if stop > old_stop:
+            _prefault(old_stop, stop - old_stop)
+            # If locking fails (e.g. because of RLIMIT_MEMLOCK), the
+            # pages are at least read ahead.
+            _mlock(old_stop, stop - old_stop)
+        self.range[:] = start, max(stop, old_stop)
+
+
+def _unlock_range(locked_range):
+    start, stop = locked_range
+    _munlock(start, stop - start)
+
+
+class _PageLocker(_HelperThread):
+    """Move locked windows of memory-mapped files on a helper thread.
+
+    Each window is updated four times per *duration* of the window
+    (using the shortest one), as long as it is alive.
+
+    """
+
+    def __init__(self):
+        _HelperThread.__init__(self)
+        self._windows = []
+        self._interval = 1.0
+
+    def add(self, window, duration):
+        with self._cond:
+            self._windows.append(_weakref.ref(window))
+            self._interval = min(self._interval, duration / 4)
+            self._start()
+
+    def _idle(self):
+        self._windows = [ref for ref in self._windows if ref()]
+        if not self._windows:
+            self._interval = 1.0
+        return not self._windows
+
+    def _work(self):
+        with self._cond:
+            refs = list(self._windows)
+            interval = self._interval
+        for ref in refs:
+            window = ref()
+            if window is not None:
+                window.update()
+            del window
+        return interval
+
+
+class _StreamBase(_Base, _sd._StreamBase):
+    """Base class for Mixer et al. that use a PortAudio stream."""
+
+    def __init__(self, kind, qsize=None, lock_memory=False, max_actions=1024,
+                 trace_size=0, **kwargs):
+        _Base.__init__(self, qsize, lock_memory, max_actions, trace_size)
+        callback = _ffi.addressof(_lib, 'callback')
+        _sd._StreamBase.__init__(
+            self, kind=kind, dtype='float32',
+            callback=callback, userdata=self._state, **kwargs)
+        self._state.samplerate = self.samplerate
+
+    def close(self, ignore_errors=True):
+        """Close the stream and unlock memory (see `locked_memory`)."""
+        _sd._StreamBase.close(self, ignore_errors)
+        if self._memory_locker is not None:
+            with self._result_lock:
+                self._memory_locker.unlock_all()
+
+
+class _OfflineBase(_Base):
+    """Base class for OfflineMixer et al. that don't use a stream."""
+
+    def __init__(self, kind, channels, samplerate, blocksize=1024, latency=0,
+                 qsize=None, lock_memory=False, max_actions=1024,
+                 trace_size=0, actual_samplerate=None):
+        _Base.__init__(self, qsize, lock_memory, max_actions, trace_size)
+        if blocksize < 1:
+            raise ValueError('blocksize must be at least 1')
+        if kind == 'duplex':
+            input_channels, output_channels = _sd._split(channels)
+            channels = input_channels, output_channels
+            self._samplesize = 4, 4
+            self._latency = _sd._split(latency)
+        else:
+            input_channels = channels if kind == 'input' else 0
+            output_channels = channels if kind == 'output' else 0
+            self._samplesize = 4
+            self._latency = latency
+        self._channels = channels
+        self._samplerate = samplerate
+        self._actual_samplerate = actual_samplerate or samplerate
+        self._blocksize = blocksize
+        self._frames = 0
+        self._state.input_channels = input_channels
+        self._state.output_channels = output_channels
+        self._state.samplerate = samplerate
+        self._time_info = _ffi.new('PaStreamCallbackTimeInfo*')
+
+    @property
+    def channels(self):
+        """The number of channels (a pair for duplex streams)."""
+        return self._channels
+
+    @property
+    def samplerate(self):
+        """The (nominal) sampling frequency."""
+        return self._samplerate
+
+    @property
+    def samplesize(self):
+        """The size in bytes of a single sample (always 4)."""
+        return self._samplesize
+
+    @property
+    def blocksize(self):
+        """Number of frames passed to the callback in one go."""
+        return self._blocksize
+
+    @property
+    def latency(self):
+        """The (simulated) latency in seconds."""
+        return self._latency
+
+    @property
+    def dtype(self):
+        """Data type of the audio samples (always ``'float32'``)."""
+        return 'float32'
+
+    @property
+    def active(self):
+        """Always ``False``, the callback is only called by `process()`."""
+        return False
+
+    @property
+    def time(self):
+        """The current "stream time" in seconds.
+
+        This starts at ``0.0`` and is advanced by `process()`, based
+        on the *actual_samplerate* given to the constructor (by default
+        the nominal `samplerate`).
+
+        """
+        return self._frames / self._actual_samplerate
+
+    def process(self, output=None, input=None, frames=None, status_flags=0,
+                time_info=None):
+        """Call the audio callback until enough frames are processed.
+
+        The number of frames is obtained from the size of *output*
+        and/or *input* (both have to be buffers of C-contiguous
+        ``'float32'`` samples in interleaved format), unless *frames*
+        is given.  If *output* is not given (or ``None``), the output
+        signal is discarded.  If *input* is not given (or ``None``),
+        silence is used as input signal.
+
+        The callback is called repeatedly with (at most) `blocksize`
+        frames at a time, each time advancing `time` accordingly.
+        The "time info" passed to the callback is derived from `time`
+        and `latency`.  The flags given by *status_flags* are passed
+        to all callback invocations.
+
+        Instead, the time info of the first block can be given as
+        *time_info*, a triple of ``(input_adc_time, current_time,
+        output_dac_time)``.  For the following blocks, all three
+        values are advanced like `time`.  This can be used (e.g. in
+        tests) to simulate an arbitrary stream clock, `time` itself is
+        not changed by this.
 
-    def play_buffer(self, buffer, channels, start=0, allow_belated=True):
+        """
+        input_channels = self._state.input_channels
+        output_channels = self._state.output_channels
+        blocksize = self._blocksize
+        if output is not None:
+            output = _ffi.from_buffer('float[]', output, require_writable=True)
+            if frames is None:
+                frames = len(output) // output_channels
+            elif frames * output_channels > len(output):
+                raise ValueError('Output buffer too small')
+        if input is not None:
+            input = _ffi.from_buffer('float[]', input)
+            if frames is None:
+                frames = len(input) // input_channels
+            elif frames * input_channels > len(input):
+                raise ValueError('Input buffer too small')
+        if frames is None:
+            raise TypeError('Unable to determine number of frames')
+        if output is None:
+            output = _ffi.new('float[]', blocksize * output_channels)
+            output_stride = 0
+        else:
+            output_stride = output_channels
+        if input is None:
+            input = _ffi.new('float[]', blocksize * input_channels)
+            input_stride = 0
+        else:
+            input_stride = input_channels
+        if time_info is None:
+            input_latency, output_latency = _sd._split(self._latency)
+            offsets = -input_latency, 0, output_latency
+        else:
+            offsets = [t - self.time for t in time_info]
+        done = 0
+        while done < frames:
+            blockframes = min(blocksize, frames - done)
+            time = self.time
+            self._time_info.inputBufferAdcTime = time + offsets[0]
+            self._time_info.currentTime = time + offsets[1]
+            self._time_info.outputBufferDacTime = time + offsets[2]
+            ret = _lib.callback(
+                input + done * input_stride, output + done * output_stride,
+                blockframes, self._time_info, status_flags, self._state)
+            if ret != _lib.paContinue:
+                raise RuntimeError('Audio callback was aborted')
+            self._frames += blockframes
+            done += blockframes
+
+
+class _PlaybackBase(object):
+    """Mix-in class providing play_buffer() and play_ringbuffer()."""
+
+    #: `SampleBank` used by `play_sample()` (if no *bank* is given there).
+    sample_bank = None
+
+    def play_buffer(self, buffer, channels, start=0, allow_belated=True,
+                    gain=1.0, fade_in=0, fade_out=0, dtype=None,
+                    samplerate=None, quality='medium', matrix=None):
         """Send a buffer to the callback to be played back.
 
         After calling this, the *buffer* must not be written to anymore.
 
+        The signal is multiplied by *gain*.  Linear fades are applied
+        over the first *fade_in* and the last *fade_out* frames.
+        *fade_out* is also used if the action is stopped with
+        `cancel()` (unless another value is given there).
+
+        The samples in *buffer* can have the data type (*dtype*)
+        ``'float32'``, ``'int16'`` or ``'int32'``.  By default, the
+        ``dtype`` attribute of *buffer* (if available) is used,
+        otherwise ``'float32'``.  Integer samples are scaled to the
+        range from -1 to 1 while mixing.
+
+        If the sampling rate of *buffer* (*samplerate*) differs from
+        the one of the stream, the signal is resampled in the callback.
+        The *quality* of the resampling filter can be ``'low'``,
+        ``'medium'`` or ``'high'``, higher quality needs more CPU time.
+        Frame counts (e.g. ``done_frames``, *fade_in* and *fade_out*)
+        always refer to the frames in *buffer*.
+
+        *buffer* can also be a `MappedFile`, which is played without
+        loading the whole file into memory.  By default, its
+        ``samplerate`` is used (if available).
+
+        Instead of mapping each channel of *buffer* to one output
+        channel, a gain *matrix* can be given, which allows playing
+        each channel on any number of output channels (e.g. for
+        panning across a loudspeaker array).  The *matrix* has one row
+        per channel of *buffer* (*channels* has to be a number in this
+        case), each row contains the gains for the output channels of
+        the stream (missing values at the end of a row are ``0``).
+        A two-dimensional NumPy array can be used.  Only the non-zero
+        gains are stored and processed.  Alternatively, the *matrix*
+        can be a dictionary mapping pairs of (1-based) channel numbers
+        ``(input, output)`` to gains, where all given entries are
+        stored (e.g. for use with `add_envelope()`).
+
         """
-        channels, mapping = self._check_channels(channels, 'output')
+        channels, mapping, matrix, matrix_memory = self._new_matrix(
+            matrix, channels)
+        sampleformat, samplesize = self._check_dtype(dtype, buffer)
+        mapped = buffer if isinstance(buffer, MappedFile) else None
+        if mapped is not None:
+            buffer = mapped.buffer
+            if samplerate is None:
+                samplerate = mapped.samplerate
         buffer = _ffi.from_buffer(buffer)
-        _, samplesize = _sd._split(self.samplesize)
-        action = _ffi.new('struct action*', dict(
+        resampler, resampler_memory = self._new_resampler(
+            samplerate, quality, channels, 'output')
+        action = self._new_action(dict(
             type=PLAY_BUFFER,
             actual_time=-1.0 if allow_belated else 0.0,
             requested_time=start,
-            buffer=_ffi.cast('float*', buffer),
+            buffer=buffer,
             total_frames=len(buffer) // channels // samplesize,
+            gain=gain,
+            fade_in=fade_in,
+            fade_out=fade_out,
+            resampler=resampler,
+            matrix=matrix,
+            format=sampleformat,
             channels=channels,
             mapping=mapping,
         ))
-        self._enqueue(action, keep_alive=buffer)
+        keep_alive = buffer
+        if mapped is not None:
+            window = _LockedWindow(
+                buffer, action, channels * samplesize,
+                int(mapped.window * (samplerate or self.samplerate)))
+            keep_alive = window
+        if resampler_memory or matrix_memory:
+            keep_alive = (keep_alive,) + resampler_memory + matrix_memory
+        self._enqueue(action, keep_alive=keep_alive)
+        if mapped is not None:
+            if self._page_locker is None:
+                self._page_locker = _PageLocker()
+            self._page_locker.add(window, mapped.window)
         return action
 
     def play_ringbuffer(self, ringbuffer, channels=None, start=0,
-                        allow_belated=True):
+                        allow_belated=True, gain=1.0, fade_in=0, fade_out=0,
+                        dtype='float32', samplerate=None, quality='medium',
+                        matrix=None, fill_target=None):
         """Send a `RingBuffer` to the callback to be played back.
 
         By default, the number of channels is obtained from the ring
         buffer's :attr:`~RingBuffer.elementsize`.
 
+        *gain*, *fade_in* and *fade_out* are used like in
+        `play_buffer()`, but since playback from a ring buffer doesn't
+        have a pre-determined end, *fade_out* is only used when the
+        action is stopped with `cancel()`.  Note that the ring buffer
+        has to provide enough data for the fade-out.
+
+        The data type of the samples (*dtype*) can be ``'float32'``,
+        ``'int16'`` or ``'int32'``.
+
+        *samplerate* and *quality* can be used for resampling like in
+        `play_buffer()`.  Note that the resampling filter needs a few
+        frames after the current position, so a few frames at the end
+        of the data are not played.
+
+        A gain *matrix* can be used like in `play_buffer()`.
+
+        If the ring buffer is filled with a clock that is not
+        synchronized to the audio device (e.g. from the network), a
+        *fill_target* (in frames) can be given.  The resampling ratio
+        (which is 1 if no *samplerate* is given) is then continuously
+        adapted by a tiny amount (at most 0.1%) in order to keep the
+        number of frames in the ring buffer close to *fill_target*.
+        The ring buffer should be pre-filled to about this level.
+
         """
-        _, samplesize = _sd._split(self.samplesize)
+        action, keep_alive = self._new_play_ringbuffer_action(
+            ringbuffer, channels, start, allow_belated, gain, fade_in,
+            fade_out, dtype, samplerate, quality, matrix, fill_target)
+        self._enqueue(action, keep_alive=keep_alive)
+        return action
+
+    def _new_play_ringbuffer_action(self, ringbuffer, channels, start,
+                                    allow_belated, gain, fade_in, fade_out,
+                                    dtype, samplerate, quality, matrix=None,
+                                    fill_target=None):
+        sampleformat, samplesize = self._check_dtype(dtype)
         if channels is None:
             channels = ringbuffer.elementsize // samplesize
-        channels, mapping = self._check_channels(channels, 'output')
+        channels, mapping, matrix, matrix_memory = self._new_matrix(
+            matrix, channels)
         if ringbuffer.elementsize != samplesize * channels:
             raise ValueError('Incompatible elementsize')
-        action = _ffi.new('struct action*', dict(
+        resampler, resampler_memory = self._new_resampler(
+            samplerate, quality, channels, 'output', fill_target, ringbuffer)
+        action = self._new_action(dict(
             type=PLAY_RINGBUFFER,
             actual_time=-1.0 if allow_belated else 0.0,
             requested_time=start,
             ringbuffer=ringbuffer._ptr,
             total_frames=ULONG_MAX,
+            min_available=ULONG_MAX,
+            gain=gain,
+            fade_in=fade_in,
+            fade_out=fade_out,
+            resampler=resampler,
+            matrix=matrix,
+            format=sampleformat,
             channels=channels,
             mapping=mapping,
         ))
-        self._enqueue(action, keep_alive=ringbuffer)
+        return action, (ringbuffer,) + resampler_memory + matrix_memory
+
+    def play_file(self, file, channels=None, start=0, allow_belated=True,
+                  gain=1.0, fade_in=0, fade_out=0, prefetch=None,
+                  quality='medium'):
+        """Play a sound file, streaming it from a background thread.
+
+        *file* can be a file name or a file-like object, it is opened
+        with the soundfile_ module (which has to be installed).
+        If the sampling rate of the file differs from the one of the
+        stream, the signal is resampled (with the given *quality*, see
+        `play_buffer()`).
+
+        The file is decoded into a `RingBuffer` which holds *prefetch*
+        seconds of audio.  By default, this is derived from the
+        latency and block size of the stream.  The ring buffer is
+        refilled whenever half of it is free.  A single background
+        thread is used for all files played by a given stream, decoding
+        never happens on the thread calling this method.
+
+        This method returns the playback action immediately, but it is
+        only sent to the callback (and playback starts at *start* at
+        the earliest) once the ring buffer has been filled.  This
+        happens outside of `batch()`.  The other arguments are used
+        like in `play_ringbuffer()`.
+
+        When the end of the file is reached, the action stops after
+        the remaining data has been played.
+
+        .. _soundfile: https://python-soundfile.readthedocs.io/
+
+        """
+        import soundfile as sf
+        f = sf.SoundFile(file)
+        try:
+            if channels is None:
+                channels = f.channels
+            if prefetch is None:
+                latency = _sd._split(self.latency)[1]
+                frames = max(4 * int(latency * self.samplerate),
+                             16 * (self.blocksize or 1024))
+            else:
+                frames = int(prefetch * self.samplerate)
+            ringbuffer = RingBuffer(f.channels * 4,
+                                    1 << max(frames - 1, 1).bit_length())
+            action, keep_alive = self._new_play_ringbuffer_action(
+                ringbuffer, channels, start, allow_belated, gain, fade_in,
+                fade_out, 'float32', f.samplerate, quality)
+            action.layout = self._select_layout(action)
+            if self._file_streamer is None:
+                self._file_streamer = _FileStreamer(self)
+            # NB: The action is registered now, but only sent when the
+            #     ring buffer is filled.
+            self._register_action(action, keep_alive)
+            self._file_streamer.add(f, ringbuffer, action)
+        except BaseException:
+            f.close()
+            raise
         return action
 
+    def play_sample(self, id, channels=None, start=0, allow_belated=True,
+                    gain=1.0, fade_in=0, fade_out=0, quality='medium',
+                    matrix=None, bank=None):
+        """Play a sample from a `SampleBank`.
 
-class Recorder(_Base):
-    """PortAudio input stream for realtime recording.
+        The sample with the given *id* is taken from *bank*, which
+        defaults to the `sample_bank` attribute.  The sample data is
+        not copied, and (unless resampling is needed) no memory is
+        allocated, the action is taken from the pre-allocated pool.
+        While the action is running, the sample is not evicted from
+        the bank.
 
-    Takes the same keyword arguments as `sounddevice.InputStream`,
-    except *callback* (a callback function implemented in C is used
-    internally) and *dtype* (which is always ``'float32'``).
+        By default, the channels of the sample are played on the first
+        output channels.  If the sampling rate of the sample differs
+        from the one of the stream, it is resampled with the given
+        *quality*.  The other arguments are used like in
+        `play_buffer()`.
 
-    Uses default values from `sounddevice.default` (except *dtype*,
-    which is always ``'float32'``).
+        """
+        if bank is None:
+            bank = self.sample_bank
+            if bank is None:
+                raise RuntimeError('No sample_bank available')
+        sample = bank._acquire(id)
+        try:
+            if channels is None:
+                channels = sample.channels
+            channels, mapping, matrix, matrix_memory = self._new_matrix(
+                matrix, channels)
+            if channels != sample.channels:
+                raise ValueError(
+                    'Sample has {} channel(s), not {}'.format(
+                        sample.channels, channels))
+            resampler, resampler_memory = self._new_resampler(
+                sample.samplerate, quality, channels, 'output')
+            action = self._new_action(dict(
+                type=PLAY_BUFFER,
+                actual_time=-1.0 if allow_belated else 0.0,
+                requested_time=start,
+                buffer=sample.pointer,
+                total_frames=sample.frames,
+                gain=gain,
+                fade_in=fade_in,
+                fade_out=fade_out,
+                resampler=resampler,
+                matrix=matrix,
+                format=bank._format,
+                channels=channels,
+                mapping=mapping,
+            ))
+        except BaseException:
+            bank._release(sample)
+            raise
+        keep_alive = bank
+        if resampler_memory or matrix_memory:
+            keep_alive = (bank,) + resampler_memory + matrix_memory
+        # NB: The sample is released when the action is removed
+        self._samples[action] = bank, sample
+        try:
+            self._enqueue(action, keep_alive=keep_alive)
+        except BaseException:
+            self._release_sample(action)
+            raise
+        return action
 
-    Has the same methods and attributes as `Mixer`, except that
-    `play_buffer()` and `play_ringbuffer()` are replaced by:
+    def add_envelope(self, action, breakpoints, entry=None,
+                     in_frames=False):
+        """Change the gain of a playback action over time.
 
-    """
+        *breakpoints* is a sequence of ``(time, value)`` pairs, sorted
+        by time.  Between the breakpoints, the gain is interpolated
+        linearly.  Before the first breakpoint, the previous gain is
+        kept, after the last one, its value is kept.  The gain is
+        updated every 16 frames.
 
-    def __init__(self, **kwargs):
-        _Base.__init__(self, kind='input', **kwargs)
-        self._state.input_channels = self.channels
+        By default, the times are given as stream time (see `time`).
+        If *action* has not started yet, its start time is estimated
+        from its requested start time and the output latency.
+        If *in_frames* is true, they are given as frame positions
+        within *action* (counted from its start, in frames of its
+        buffer, like ``done_frames``).
 
-    def record_buffer(self, buffer, channels, start=0, allow_belated=True):
+        By default, the gain of *action* (see `play_buffer()`) is
+        changed, which is multiplied with the fades.  Instead, an
+        *entry* of the gain matrix of *action* can be given as pair of
+        channel numbers ``(input, output)``.  *action* can also be an
+        action created with `route()`.
+
+        This can be called repeatedly (also while *action* is running)
+        to append further envelope segments, which should not overlap.
+        The new envelope is sent to the callback immediately, segments
+        which already lie in the past only set the gain to their last
+        value.
+
+        """
+        if action.type not in (PLAY_BUFFER, PLAY_RINGBUFFER, ROUTE):
+            raise ValueError('Envelopes are only supported for playback')
+        if not breakpoints:
+            raise ValueError('At least one breakpoint is needed')
+        if entry is None:
+            target = _ffi.addressof(action[0], 'gain')
+        else:
+            if not action.matrix:
+                raise ValueError('Action has no gain matrix')
+            input, output = entry
+            for i in range(action.matrix.size):
+                e = action.matrix.entries[i]
+                if (e.input, e.output) == (input - 1, output - 1):
+                    target = _ffi.addressof(e, 'gain')
+                    break
+            else:
+                raise ValueError('Entry {} is not part of the gain matrix '
+                                 '(use a dictionary)'.format(entry))
+        if in_frames:
+            frames = [frame for frame, _ in breakpoints]
+        else:
+            reference = action.actual_time
+            if reference <= 0:
+                # Not started yet, it starts with the next block at the
+                # earliest (which is played after the output latency)
+                reference = max(
+                    action.requested_time,
+                    self.time + _sd._split(self.latency)[1])
+            ratio = self.samplerate
+            if action.resampler.step > 0:
+                ratio *= action.resampler.step
+            frames = [max(int(round((time - reference) * ratio)), 0)
+                      for time, _ in breakpoints]
+        if any(a > b for a, b in zip(frames, frames[1:])):
+            raise ValueError('Breakpoints must be sorted by time')
+        memory = _ffi.new('struct breakpoint[]', [
+            dict(frame=frame, value=value)
+            for frame, (_, value) in zip(frames, breakpoints)])
+        envelope = _ffi.new('struct envelope*', dict(
+            action=action,
+            target=target,
+            breakpoints=memory,
+            size=len(memory),
+        ))
+        memory = envelope, memory
+        with self._result_lock:
+            # NB: The envelope is used as long as the action is running
+            if action in self._actions:
+                self._actions[action] = self._actions[action], memory
+                if self._memory_locker is not None:
+                    self._memory_locker.lock(action, memory)
+            elif self._batch is not None:
+                # The action may not be registered yet
+                for i, (other, keep_alive) in enumerate(self._batch):
+                    if other == action:
+                        self._batch[i] = other, (keep_alive, memory)
+                        break
+        envelope_action = self._new_action(dict(
+            type=ENVELOPE,
+            actual_time=-1.0,
+            envelope=envelope,
+        ))
+        self._enqueue(envelope_action, keep_alive=(action,) + memory)
+        return envelope_action
+
+    def set_output_processing(self, channels, biquads=(), gain=1.0,
+                              delay=0, limit=None, release=0.05, time=0,
+                              allow_belated=True):
+        """Set the processing chain applied to the mixed output signal.
+
+        Each of the given output *channels* is processed separately,
+        after all playback actions have been mixed.  The processing
+        chain consists of cascaded *biquads* (second-order sections),
+        a *delay* (in frames), a *gain* and a "brickwall" limiter.
+
+        *biquads* is a sequence of up to 8 sections, each given as
+        ``(b0, b1, b2, a0, a1, a2)``, which is the format used for
+        ``sos`` filters in ``scipy.signal``.
+
+        If a *limit* is given, the absolute value of the output signal
+        never exceeds it.  The gain reduction happens instantaneously
+        (without any look-ahead) and is released with a time constant
+        of *release* seconds.
+
+        The new parameters are applied to all blocks starting with the
+        one that contains *time*.  The state of the filters is kept,
+        the delay line is kept as long as the maximum delay doesn't
+        grow.  Each call replaces all parameters of the given
+        *channels*; to switch the processing off, call this method
+        with the default arguments.
+
+        """
+        channels, mapping = self._check_channels(channels, 'output')
+        if len(biquads) > MAX_BIQUADS:
+            raise ValueError(
+                'Too many biquads (maximum is {})'.format(MAX_BIQUADS))
+        if delay < 0:
+            raise ValueError('delay must not be negative')
+        if limit is not None and limit <= 0:
+            raise ValueError('limit must be positive')
+        coefficients = []
+        for b0, b1, b2, a0, a1, a2 in biquads:
+            coefficients.append(dict(
+                b0=b0 / a0, b1=b1 / a0, b2=b2 / a0, a1=a1 / a0, a2=a2 / a0))
+        if self._outputs is None:
+            output_channels = _sd._split(self.channels)[1]
+            outputs = _ffi.new('struct outputchain[]', [
+                dict(processing=dict(gain=1.0), limiter_gain=1.0)
+            ] * output_channels)
+            if self._memory_locker is not None:
+                self._memory_locker.lock(None, outputs)
+            # NB: This is installed by the callback, see below
+            self._outputs = outputs
+        processing = []
+        for channel in mapping:
+            # NB: Delay lines are never freed while the stream exists,
+            #     because pending actions may still switch back to them.
+            delay_lines = self._delay_lines.setdefault(channel, [])
+            if delay and (not delay_lines or len(delay_lines[-1]) <= delay):
+                delay_lines.append(_ffi.new(
+                    'float[]', 1 << delay.bit_length()))
+                if self._memory_locker is not None:
+                    self._memory_locker.lock(None, delay_lines[-1])
+            # NB: Once allocated, the delay line is also used for a delay
+            #     of 0, to avoid stale data when the delay is used again.
+            delay_line = delay_lines[-1] if delay_lines else _ffi.NULL
+            delay_size = len(delay_lines[-1]) if delay_lines else 0
+            processing.append(dict(
+                biquad_count=len(coefficients),
+                biquads=coefficients,
+                gain=gain,
+                delay=delay,
+                delay_line=delay_line,
+                delay_size=delay_size,
+                limit=limit or 0.0,
+                release=_math.exp(-1 / (release * self.samplerate))
+                if release > 0 else 0.0,
+            ))
+        processing = _ffi.new('struct processing[]', processing)
+        action = self._new_action(dict(
+            type=SET_OUTPUT_PROCESSING,
+            actual_time=-1.0 if allow_belated else 0.0,
+            requested_time=time,
+            processing=processing,
+            outputs=self._outputs,
+            channels=channels,
+            mapping=mapping,
+        ))
+        self._enqueue(action, keep_alive=(processing, self._outputs))
+        return action
+
+    def convolve(self, ir, inputs, outputs, start=0, allow_belated=True,
+                 post_mix=False):
+        """Convolve input channels with a matrix of impulse responses.
+
+        *ir* has to be a buffer of C-contiguous ``'float32'`` samples
+        with the shape ``(frames, len(inputs), len(outputs))``, i.e.
+        for each frame, there is one row of values (one value per
+        output channel) for each input channel.  *inputs* and *outputs*
+        are lists of (1-based) channel numbers (or numbers of channels,
+        like *channels* in `play_buffer()`).  The convolved signals are
+        mixed into the *outputs*.
+
+        By default, the *inputs* are input channels of the stream
+        (which is only possible with `MixerAndRecorder`).  If
+        *post_mix* is true, the *inputs* are output channels instead,
+        which are convolved after all other actions have been mixed.
+        In this case, the *outputs* are overwritten with the result.
+
+        The convolution is done in the callback with uniformly
+        partitioned overlap-save FFT convolution, without additional
+        latency.  The partition size is the `blocksize` of the stream,
+        which has to be a power of 2 (and not ``0``).  Blocks of a
+        different size (e.g. a short last block in
+        `OfflineMixer.process()`) are not processed.
+
+        The convolution starts at the beginning of the block containing
+        *start* and runs until it is stopped with `cancel()`.
+
+        """
+        blocksize = self.blocksize
+        if not blocksize or blocksize & (blocksize - 1):
+            raise ValueError(
+                'Convolution needs a blocksize which is a power of 2')
+        if post_mix:
+            inputs, input_mapping = self._check_channels(inputs, 'output')
+        else:
+            if not self._state.input_channels:
+                raise ValueError('Stream has no input channels')
+            inputs, input_mapping = self._check_channels(inputs, 'input')
+        outputs, output_mapping = self._check_channels(outputs, 'output')
+        ir = _ffi.from_buffer('float[]', ir)
+        if len(ir) % (inputs * outputs):
+            raise ValueError('Size of ir must be a multiple of {}'.format(
+                inputs * outputs))
+        frames = len(ir) // (inputs * outputs)
+        partitions = max(-(-frames // blocksize), 1)
+        bins = blocksize + 1
+        twiddle = _ffi.new('float[]', [
+            f
+            for k in range(blocksize)
+            for f in (_math.cos(_math.pi * k / blocksize),
+                      -_math.sin(_math.pi * k / blocksize))
+        ])
+        memory = (
+            twiddle,
+            _ffi.new('float[]', 2 * bins * partitions * inputs * outputs),
+            _ffi.new('float[]', 2 * bins * partitions * inputs),
+            _ffi.new('float[]', blocksize * inputs),
+            _ffi.new('float[]', 4 * blocksize),
+        )
+        convolution = _ffi.new('struct convolution*', dict(
+            partition_size=blocksize,
+            partitions=partitions,
+            inputs=inputs,
+            outputs=outputs,
+            post_mix=post_mix,
+            twiddle=memory[0],
+            filters=memory[1],
+            spectra=memory[2],
+            previous=memory[3],
+            scratch=memory[4],
+        ))
+        _lib.prepare_convolution(convolution, ir, frames)
+        action = self._new_action(dict(
+            type=CONVOLVE,
+            actual_time=-1.0 if allow_belated else 0.0,
+            requested_time=start,
+            convolution=convolution,
+            total_frames=ULONG_MAX,
+            channels=inputs + outputs,
+            mapping=tuple(input_mapping) + tuple(output_mapping),
+        ))
+        self._enqueue(action, keep_alive=(convolution,) + memory)
+        return action
+
+    def route(self, inputs, outputs, start=0, allow_belated=True, gain=1.0,
+              fade_in=0, fade_out=0, delay=0):
+        """Mix input channels into output channels, e.g. for monitoring.
+
+        This is only possible with `MixerAndRecorder`.  *inputs* and
+        *outputs* are lists of (1-based) channel numbers (or numbers of
+        channels, like *channels* in `play_buffer()`) of equal length,
+        each input channel is mixed into the corresponding output
+        channel.  The same channel may be used multiple times.
+
+        The signal is copied directly in the callback, optionally
+        delayed by *delay* frames (in addition to the latency of the
+        stream).  Unlike a combination of `record_ringbuffer()` and
+        `play_ringbuffer()`, this cannot run out of data, so it keeps
+        running after buffer over-/underflows of the stream.
+
+        *gain*, *fade_in* and *fade_out* are used like in
+        `play_ringbuffer()`.  Like for playback, *start* refers to the
+        time when the output signal is heard.  The action runs until it
+        is stopped with `cancel()`.
+
+        """
+        if not self._state.input_channels:
+            raise ValueError('Stream has no input channels')
+        inputs, input_mapping = self._check_channels(inputs, 'input')
+        outputs, output_mapping = self._check_channels(outputs, 'output')
+        if inputs != outputs:
+            raise ValueError('Number of inputs and outputs must be equal')
+        if delay < 0:
+            raise ValueError('delay must not be negative')
+        delay_line = _ffi.NULL
+        delay_size = 0
+        if delay:
+            delay_size = 1 << delay.bit_length()
+            delay_line = _ffi.new('float[]', delay_size * inputs)
+        route = _ffi.new('struct route*', dict(
+            delay=delay,
+            delay_line=delay_line,
+            delay_size=delay_size,
+        ))
+        action = self._new_action(dict(
+            type=ROUTE,
+            actual_time=-1.0 if allow_belated else 0.0,
+            requested_time=start,
+            route=route,
+            total_frames=ULONG_MAX,
+            gain=gain,
+            fade_in=fade_in,
+            fade_out=fade_out,
+            channels=2 * inputs,
+            mapping=tuple(input_mapping) + tuple(output_mapping),
+        ))
+        self._enqueue(action, keep_alive=(route, delay_line))
+        return action
+
+
+class _RecordingBase(object):
+    """Mix-in class providing record_buffer() and record_ringbuffer()."""
+
+    def record_buffer(self, buffer, channels, start=0, allow_belated=True,
+                      dtype=None, samplerate=None, quality='medium'):
         """Send a buffer to the callback to be recorded into.
 
+        The samples are converted to the data type (*dtype*)
+        ``'float32'``, ``'int16'`` or ``'int32'``.  By default, the
+        ``dtype`` attribute of *buffer* (if available) is used,
+        otherwise ``'float32'``.  Values outside of the range from -1
+        to 1 are clipped when converting to integers.
+
+        If *samplerate* is given (and it differs from the sampling
+        rate of the stream), the signal is resampled to this rate in
+        the callback, see `play_buffer()`.
+
         """
         channels, mapping = self._check_channels(channels, 'input')
+        sampleformat, samplesize = self._check_dtype(dtype, buffer)
         buffer = _ffi.from_buffer(buffer)
-        samplesize, _ = _sd._split(self.samplesize)
-        action = _ffi.new('struct action*', dict(
+        resampler, resampler_memory = self._new_resampler(
+            samplerate, quality, channels, 'input')
+        action = self._new_action(dict(
             type=RECORD_BUFFER,
             actual_time=-1.0 if allow_belated else 0.0,
             requested_time=start,
-            buffer=_ffi.cast('float*', buffer),
+            buffer=buffer,
             total_frames=len(buffer) // channels // samplesize,
+            resampler=resampler,
+            format=sampleformat,
             channels=channels,
             mapping=mapping,
         ))
-        self._enqueue(action, keep_alive=buffer)
+        self._enqueue(action, keep_alive=(buffer,) + resampler_memory)
         return action
 
     def record_ringbuffer(self, ringbuffer, channels=None, start=0,
-                          allow_belated=True):
+                          allow_belated=True, dtype='float32',
+                          samplerate=None, quality='medium',
+                          fill_target=None):
         """Send a `RingBuffer` to the callback to be recorded into.
 
         By default, the number of channels is obtained from the ring
         buffer's :attr:`~RingBuffer.elementsize`.
 
+        The samples are converted to *dtype* and resampled to
+        *samplerate* like in `record_buffer()`.
+
+        A *fill_target* can be used like in `play_ringbuffer()`, the
+        number of frames in the ring buffer (i.e. the frames which
+        have not yet been read) is kept close to it.
+
         """
-        samplesize, _ = _sd._split(self.samplesize)
+        sampleformat, samplesize = self._check_dtype(dtype)
         if channels is None:
             channels = ringbuffer.elementsize // samplesize
         channels, mapping = self._check_channels(channels, 'input')
         if ringbuffer.elementsize != samplesize * channels:
             raise ValueError('Incompatible elementsize')
-        action = _ffi.new('struct action*', dict(
+        resampler, resampler_memory = self._new_resampler(
+            samplerate, quality, channels, 'input', fill_target, ringbuffer)
+        action = self._new_action(dict(
             type=RECORD_RINGBUFFER,
             actual_time=-1.0 if allow_belated else 0.0,
             requested_time=start,
             ringbuffer=ringbuffer._ptr,
             total_frames=ULONG_MAX,
+            min_available=ULONG_MAX,
+            resampler=resampler,
+            format=sampleformat,
             channels=channels,
             mapping=mapping,
         ))
-        self._enqueue(action, keep_alive=ringbuffer)
+        self._enqueue(action, keep_alive=(ringbuffer,) + resampler_memory)
         return action
 
 
+class Mixer(_PlaybackBase, _StreamBase):
+    """PortAudio output stream for realtime mixing.
+
+    Takes the same keyword arguments as `sounddevice.OutputStream`,
+    except *callback* (a callback function implemented in C is used
+    internally) and *dtype* (which is always ``'float32'``).
+
+    Uses default values from `sounddevice.default` (except *dtype*,
+    which is always ``'float32'``).
+
+    The sizes of the action queue and the result queue can be set with
+    *max_actions* or *qsize*, see `queue_highwater`.
+    With ``lock_memory=True``, the memory used by the audio callback
+    is locked in memory, see `locked_memory`.
+    Events in the audio callback can be traced by setting
+    *trace_size*, see `read_trace()`.
+
+    Has the same methods and attributes as `sounddevice.OutputStream`
+    (except :meth:`~sounddevice.Stream.write` and
+    :attr:`~sounddevice.Stream.write_available`), plus the following:
+
+    """
+
+    def __init__(self, **kwargs):
+        _StreamBase.__init__(self, kind='output', **kwargs)
+        self._state.output_channels = self.channels
+
+
+class Recorder(_RecordingBase, _StreamBase):
+    """PortAudio input stream for realtime recording.
+
+    Takes the same keyword arguments as `sounddevice.InputStream`,
+    except *callback* (a callback function implemented in C is used
+    internally) and *dtype* (which is always ``'float32'``).
+
+    Uses default values from `sounddevice.default` (except *dtype*,
+    which is always ``'float32'``).
+
+    Has the same methods and attributes as `Mixer`, except that
+    `play_buffer()` and `play_ringbuffer()` are replaced by:
+
+    """
+
+    def __init__(self, **kwargs):
+        _StreamBase.__init__(self, kind='input', **kwargs)
+        self._state.input_channels = self.channels
+
+
 class MixerAndRecorder(Mixer, Recorder):
     """PortAudio stream for realtime mixing and recording.
 
@@ -290,6 +2143,466 @@ class MixerAndRecorder(Mixer, Recorder):
     """
 
     def __init__(self, **kwargs):
-        _Base.__init__(self, kind='duplex', **kwargs)
+        _StreamBase.__init__(self, kind='duplex', **kwargs)
         self._state.input_channels = self.channels[0]
         self._state.output_channels = self.channels[1]
+
+
+class OfflineMixer(_PlaybackBase, _OfflineBase):
+    """Mixer that is driven by `process()` instead of a PortAudio stream.
+
+    This uses the same audio callback as `Mixer`, but instead of
+    being called by PortAudio in realtime, the callback is called
+    (as fast as possible) from `process()`, which renders the mixed
+    signal into a given buffer.  No audio hardware is needed.
+
+    *channels* and *samplerate* are required.  The callback is called
+    with *blocksize* frames at a time.  The given *latency* (in
+    seconds) is used to calculate ``outputBufferDacTime`` (and
+    ``inputBufferAdcTime``) from the current `time`.
+
+    An *actual_samplerate* can be given to simulate an audio device
+    whose clock deviates from the stream time (see
+    `estimated_samplerate`).
+
+    Has the same methods and attributes as `Mixer`, plus the following:
+
+    """
+
+    def __init__(self, channels, samplerate, **kwargs):
+        _OfflineBase.__init__(self, 'output', channels, samplerate, **kwargs)
+
+
+class OfflineRecorder(_RecordingBase, _OfflineBase):
+    """Recorder that is driven by `process()` instead of a PortAudio stream.
+
+    See `OfflineMixer` for the parameters.
+
+    Has the same methods and attributes as `Recorder`, plus the
+    following:
+
+    """
+
+    def __init__(self, channels, samplerate, **kwargs):
+        _OfflineBase.__init__(self, 'input', channels, samplerate, **kwargs)
+
+
+class OfflineMixerAndRecorder(OfflineMixer, OfflineRecorder):
+    """MixerAndRecorder that is driven by `process()`.
+
+    See `OfflineMixer` for the parameters.  *channels* (and *latency*)
+    can be either a single value or a pair of values for input and
+    output.
+
+    Inherits all methods and attributes from `OfflineMixer` and
+    `OfflineRecorder`.
+
+    """
+
+    def __init__(self, channels, samplerate, **kwargs):
+        _OfflineBase.__init__(self, 'duplex', channels, samplerate, **kwargs)
+
+
+class MappedFile(object):
+    """Memory-mapped sound file for playback with `Mixer.play_buffer()`.
+
+    The file (*filename*) can contain raw sample data or it can be a
+    WAV file (with samples of type 16 or 32 bit integer or 32 bit
+    floating point).  For raw data, *channels* has to be specified,
+    *dtype* defaults to ``'float32'`` and *offset* (in bytes) can be
+    used to skip a header.  For WAV files, all this is taken from the
+    file header.
+
+    The file is not loaded into memory.  During playback, a helper
+    thread keeps the pages of the upcoming *window* seconds of data
+    resident in memory (using ``mlock()``, see :manpage:`mlock(2)`),
+    in order to avoid page faults in the audio callback.  Pages behind
+    the playhead are unlocked again.  If the pages cannot be locked
+    (e.g. because ``RLIMIT_MEMLOCK`` is too low), they are only read
+    ahead with ``madvise()``.  On Windows, no locking is done.
+
+    """
+
+    def __init__(self, filename, channels=None, dtype=None, offset=0,
+                 window=2.0):
+        with open(filename, 'rb') as f:
+            self._mmap = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        self.samplerate = None
+        size = len(self._mmap) - offset
+        if self._mmap[:4] == b'RIFF' and self._mmap[8:12] == b'WAVE':
+            if channels is not None or dtype is not None:
+                raise ValueError(
+                    'channels and dtype are taken from the WAV header')
+            (offset, size, channels, dtype,
+             self.samplerate) = _parse_wav_header(self._mmap)
+        elif channels is None:
+            raise ValueError('channels must be specified for raw files')
+        elif dtype is None:
+            dtype = 'float32'
+        self.channels = channels
+        self.dtype = str(dtype)
+        try:
+            samplesize = {'float32': 4, 'int16': 2, 'int32': 4}[self.dtype]
+        except KeyError:
+            raise ValueError('Unsupported dtype: {!r}'.format(self.dtype))
+        self.frames = size // (channels * samplesize)
+        self.window = window
+        self.buffer = memoryview(self._mmap)[
+            offset:offset + self.frames * channels * samplesize]
+
+
+def _parse_wav_header(data):
+    """Get (offset, size, channels, dtype, samplerate) of WAV data."""
+    position = 12
+    fmt = None
+    while position + 8 <= len(data):
+        chunk_id = data[position:position + 4]
+        chunk_size, = _struct.unpack('<I', data[position + 4:position + 8])
+        position += 8
+        if chunk_id == b'fmt ':
+            fmt = _struct.unpack('<HHIIHH', data[position:position + 16])
+            if fmt[0] == 0xFFFE and chunk_size >= 40:
+                # WAVE_FORMAT_EXTENSIBLE: format tag is start of GUID
+                tag, = _struct.unpack('<H', data[position + 24:position + 26])
+                fmt = (tag,) + fmt[1:]
+        elif chunk_id == b'data':
+            break
+        position += chunk_size + chunk_size % 2
+    else:
+        raise ValueError('No data chunk found in WAV file')
+    if fmt is None:
+        raise ValueError('No fmt chunk found in WAV file')
+    tag, channels, samplerate, _, _, bits = fmt
+    try:
+        dtype = {(1, 16): 'int16', (1, 32): 'int32', (3, 32): 'float32'}[
+            tag, bits]
+    except KeyError:
+        raise ValueError(
+            'Unsupported WAV format: tag {}, {} bits'.format(tag, bits))
+    size = min(chunk_size, len(data) - position)
+    return position, size, channels, dtype, samplerate
+
+
+class SampleBank(object):
+    """Memory for samples which are played with `Mixer.play_sample()`.
+
+    The samples are stored in a single contiguous memory block (the
+    "arena") of *size* bytes, with data type *dtype*, which can be
+    ``'float32'``, ``'int16'`` (which needs half the memory) or
+    ``'int32'``.  Sound files are decoded only once, when they are
+    loaded into the bank.
+
+    Each sample is addressed by an *id* (any hashable object).  If
+    there is not enough free space for a new sample, the least
+    recently used samples (i.e. loaded or played) are evicted, except
+    for those which are currently being played by an action.
+
+    With ``lock_memory=True``, the arena is locked in memory.  This
+    should be used together with the *lock_memory* argument of the
+    stream, because the arena is not locked by the stream itself.
+
+    """
+
+    # Alignment (in bytes) of the start of each sample in the arena
+    _ALIGNMENT = 16
+
+    def __init__(self, size, dtype='float32', lock_memory=False):
+        self.size = size
+        self.dtype = str(dtype)
+        try:
+            self._format, self._samplesize = {
+                'float32': (FLOAT32_FORMAT, 4),
+                'int16': (INT16_FORMAT, 2),
+                'int32': (INT32_FORMAT, 4),
+            }[self.dtype]
+        except KeyError:
+            raise ValueError('Unsupported dtype: {!r}'.format(self.dtype))
+        self._arena = _ffi.new('char[]', size)
+        self._samples = _collections.OrderedDict()
+        # Ranges which are reserved while a file is being decoded
+        self._pending = []
+        self._lock = _threading.Lock()
+        self._memory_locker = None
+        if lock_memory:
+            self._memory_locker = _MemoryLocker()
+            self._memory_locker.lock(None, self._arena)
+            _weakref.finalize(self, self._memory_locker.unlock_all)
+
+    def __contains__(self, id):
+        return id in self._samples
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def used(self):
+        """Number of bytes used by the samples in the bank."""
+        with self._lock:
+            return sum(sample.size for sample in self._samples.values())
+
+    def add(self, id, data, channels=1, samplerate=None):
+        """Copy *data* into the bank, as sample *id*.
+
+        *data* has to support the buffer protocol and must contain
+        interleaved samples with the data type of the bank.  If no
+        *samplerate* is given, the sample is played with the sampling
+        rate of the stream.  An existing sample with the same *id* is
+        replaced (if it is not being played).
+
+        """
+        dtype = getattr(data, 'dtype', self.dtype)
+        if str(dtype) != self.dtype:
+            raise ValueError('Data type must be {!r}'.format(self.dtype))
+        data = _ffi.from_buffer(data)
+        framesize = channels * self._samplesize
+        if len(data) % framesize:
+            raise ValueError('Incomplete frame in data')
+        with self._lock:
+            self._remove(id)
+            offset = self._allocate(len(data))
+            _ffi.memmove(self._arena + offset, data, len(data))
+            self._insert(id, offset, len(data) // framesize, channels,
+                         samplerate)
+
+    def load(self, file, id=None):
+        """Decode a sound file into the bank and return its *id*.
+
+        *file* is opened with the soundfile_ module, its name is used
+        as *id* by default.  If a sample with the given *id* is already
+        in the bank, the file is not decoded again, the sample is only
+        marked as recently used.  Decoding happens without blocking
+        `Mixer.play_sample()`.
+
+        .. _soundfile: https://python-soundfile.readthedocs.io/
+
+        """
+        import soundfile as sf
+        if id is None:
+            id = getattr(file, 'name', file)
+        with self._lock:
+            if id in self._samples:
+                self._samples.move_to_end(id)
+                return id
+        with sf.SoundFile(file) as f:
+            size = f.frames * f.channels * self._samplesize
+            with self._lock:
+                offset = self._allocate(size)
+                self._pending.append((offset, size))
+            try:
+                frames = f.buffer_read_into(
+                    _ffi.buffer(self._arena + offset, size), self.dtype)
+            finally:
+                with self._lock:
+                    self._pending.remove((offset, size))
+            with self._lock:
+                self._remove(id)
+                self._insert(id, offset, frames, f.channels, f.samplerate)
+        return id
+
+    def remove(self, id):
+        """Remove sample *id* from the bank.
+
+        Raises `ValueError` if the sample is currently being played.
+
+        """
+        with self._lock:
+            if id not in self._samples:
+                raise KeyError(id)
+            self._remove(id)
+
+    def _remove(self, id):
+        sample = self._samples.get(id)
+        if sample is None:
+            return
+        if sample.playing:
+            raise ValueError('Sample {!r} is being played'.format(id))
+        del self._samples[id]
+
+    def _insert(self, id, offset, frames, channels, samplerate):
+        self._samples[id] = _Sample(
+            offset=offset,
+            size=frames * channels * self._samplesize,
+            frames=frames,
+            channels=channels,
+            samplerate=samplerate,
+            pointer=self._arena + offset,
+        )
+
+    def _allocate(self, size):
+        """Return offset of free range, evict samples if needed."""
+        if size > self.size:
+            raise MemoryError('Sample is larger than the sample bank')
+        while True:
+            offset = self._find_gap(size)
+            if offset is not None:
+                return offset
+            # Least recently used first
+            for id, sample in self._samples.items():
+                if not sample.playing:
+                    del self._samples[id]
+                    break
+            else:
+                raise MemoryError(
+                    'Not enough free space in sample bank '
+                    '(all remaining samples are being played)')
+
+    def _find_gap(self, size):
+        """Return offset of first (aligned) gap of *size* bytes, or None."""
+        ranges = [(sample.offset, sample.size)
+                  for sample in self._samples.values()]
+        position = 0
+        for offset, used in sorted(ranges + self._pending):
+            if offset - position >= size:
+                return position
+            position = offset + used
+            position += -position % self._ALIGNMENT
+        if self.size - position >= size:
+            return position
+        return None
+
+    def _acquire(self, id):
+        """Get sample for playback, it is not evicted until released."""
+        with self._lock:
+            sample = self._samples[id]
+            self._samples.move_to_end(id)
+            sample.playing += 1
+        return sample
+
+    def _release(self, sample):
+        with self._lock:
+            sample.playing -= 1
+
+
+class _Sample(object):
+    """Location and properties of a sample in a SampleBank."""
+
+    __slots__ = ('offset', 'size', 'frames', 'channels', 'samplerate',
+                 'pointer', 'playing')
+
+    def __init__(self, offset, size, frames, channels, samplerate, pointer):
+        self.offset = offset
+        self.size = size
+        self.frames = frames
+        self.channels = channels
+        self.samplerate = samplerate
+        self.pointer = pointer
+        # Number of actions which are playing the sample
+        self.playing = 0
+
+
+class AsyncMixer(object):
+    """Wrapper for playing from ring buffers within an `asyncio` loop.
+
+    *mixer* can be a `Mixer` or a `MixerAndRecorder` (or one of their
+    offline variants), it is available as `mixer` attribute.
+
+    Instead of polling, the coroutines sleep until enough space is
+    expected to be available in the ring buffer (based on the
+    sampling rate of the stream).
+
+    """
+
+    def __init__(self, mixer):
+        self.mixer = mixer
+        self._actions = _weakref.WeakKeyDictionary()
+
+    def play_ringbuffer(self, ringbuffer, *args, **kwargs):
+        """Start playback, see `Mixer.play_ringbuffer()`.
+
+        Afterwards, data can be written to *ringbuffer* with `feed()`.
+
+        """
+        action = self.mixer.play_ringbuffer(ringbuffer, *args, **kwargs)
+        self._actions[ringbuffer] = action
+        return action
+
+    async def feed(self, ringbuffer, data):
+        """Write *data* to *ringbuffer*, waiting for space if needed.
+
+        This can be used before and after calling `play_ringbuffer()`.
+        If not all data fits into the ring buffer, this waits until
+        half of the ring buffer (or enough for the rest of *data*) is
+        free.  A `RuntimeError` is raised if the playback (started
+        with `play_ringbuffer()`) has stopped in the meantime (e.g.
+        because the ring buffer ran empty).
+
+        """
+        data = memoryview(data).cast('B')
+        elementsize = ringbuffer.elementsize
+        frames, rest = divmod(len(data), elementsize)
+        if rest:
+            raise ValueError('data size must be multiple of elementsize')
+        size = ringbuffer.read_available + ringbuffer.write_available
+        while True:
+            written = ringbuffer.write(data, frames)
+            data = data[written * elementsize:]
+            frames -= written
+            if not frames:
+                break
+            action = self._actions.get(ringbuffer)
+            if action is not None and action not in self.mixer.actions:
+                raise RuntimeError('Playback from ring buffer has stopped')
+            missing = min(frames, size // 2) - ringbuffer.write_available
+            await _asyncio.sleep(max(missing, 1) / self.mixer.samplerate)
+
+    async def wait(self, action=None):
+        """Wait for *action* to be finished, see `Mixer.wait_async()`."""
+        await self.mixer.wait_async(action)
+
+
+class AsyncRecorder(object):
+    """Wrapper for recording into ring buffers within an `asyncio` loop.
+
+    *recorder* can be a `Recorder` or a `MixerAndRecorder` (or one of
+    their offline variants), it is available as `recorder` attribute.
+
+    """
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    async def stream(self, ringbuffer, blocksize=None, **kwargs):
+        """Record into *ringbuffer* and yield blocks of recorded data.
+
+        This is an asynchronous generator to be used with
+        ``async for``.  It starts recording with
+        `Recorder.record_ringbuffer()` (which gets all keyword
+        arguments) and yields buffer objects containing *blocksize*
+        frames each.  By default, *blocksize* is half the size of
+        *ringbuffer*.
+
+        Instead of polling, this sleeps until enough data is expected
+        to be available (based on the sampling rate of the stream).
+
+        When the recording stops (e.g. because of a ring buffer
+        overflow or because it was cancelled), the remaining data is
+        yielded (which may be less than *blocksize* frames) and the
+        iteration stops.  If the iteration is stopped early, the
+        recording is cancelled.
+
+        """
+        if blocksize is None:
+            size = ringbuffer.read_available + ringbuffer.write_available
+            blocksize = size // 2
+        recorder = self.recorder
+        action = recorder.record_ringbuffer(ringbuffer, **kwargs)
+        try:
+            while True:
+                available = ringbuffer.read_available
+                if available >= blocksize:
+                    yield ringbuffer.read(blocksize)
+                    continue
+                if action not in recorder.actions:
+                    # All data has been written before the action ended
+                    if ringbuffer.read_available:
+                        yield ringbuffer.read()
+                    break
+                await _asyncio.sleep(
+                    (blocksize - available) / recorder.samplerate)
+        finally:
+            if action in recorder.actions:
+                recorder.cancel(action)
+
+    async def wait(self, action=None):
+        """Wait for *action* to be finished, see `Recorder.wait_async()`."""
+        await self.recorder.wait_async(action)
@@ -0,0 +1,94 @@
+"""Scheduling tests with OfflineMixer (no audio hardware needed)."""
+from array import array
+
+import pytest
+
+import rtmixer
+
+SAMPLERATE = 48000
+BLOCKSIZE = 64
+
+
+def zeros(frames):
+    return array('f', bytes(4 * frames))
+
+
+def ones(frames):
+    return array('f', [1.0] * frames)
+
+
+@pytest.fixture
+def mixer():
+    return rtmixer.OfflineMixer(
+        channels=1, samplerate=SAMPLERATE, blocksize=BLOCKSIZE)
+
+
+def test_start_time(mixer):
+    action = mixer.play_buffer(ones(100), 1, start=150 / SAMPLERATE)
+    output = zeros(4 * BLOCKSIZE)
+    mixer.process(output)
+    assert list(output) == [0.0] * 150 + [1.0] * 100 + [0.0] * 6
+    assert action.actual_time == pytest.approx(150 / SAMPLERATE)
+    assert action.done_frames == 100
+    assert action not in mixer.actions
+
+
+def test_start_immediately(mixer):
+    mixer.process(frames=10 * BLOCKSIZE)
+    action = mixer.play_buffer(ones(10), 1)
+    output = zeros(BLOCKSIZE)
+    mixer.process(output)
+    assert list(output) == [1.0] * 10 + [0.0] * (BLOCKSIZE - 10)
+    block_time = mixer.time - BLOCKSIZE / SAMPLERATE
+    assert action.actual_time == pytest.approx(block_time)
+
+
+def test_belated(mixer):
+    mixer.process(frames=10 * BLOCKSIZE)
+    late = mixer.play_buffer(ones(10), 1, start=1 / SAMPLERATE,
+                             allow_belated=False)
+    output = zeros(BLOCKSIZE)
+    mixer.process(output)
+    assert list(output) == [0.0] * BLOCKSIZE
+    assert late.actual_time == 0.0
+    assert late not in mixer.actions
+
+
+def test_time_info(mixer):
+    # Arbitrary stream clock with an output latency of 10 ms
+    time_info = 99.99, 100.0, 100.01
+    start = 100.01 + 20 / SAMPLERATE
+    action = mixer.play_buffer(ones(10), 1, start=start)
+    output = zeros(2 * BLOCKSIZE)
+    mixer.process(output, time_info=time_info)
+    assert list(output) == [0.0] * 20 + [1.0] * 10 + [0.0] * 98
+    assert action.actual_time == pytest.approx(start)
+    assert mixer.time == 2 * BLOCKSIZE / SAMPLERATE
+
+
+def test_cancel(mixer):
+    action = mixer.play_buffer(ones(1000), 1)
+    mixer.cancel(action, time=100 / SAMPLERATE)
+    output = zeros(4 * BLOCKSIZE)
+    mixer.process(output)
+    assert list(output) == [1.0] * 100 + [0.0] * 156
+    assert action.done_frames == 100
+    assert action not in mixer.actions
+
+
+def test_cancel_before_start(mixer):
+    action = mixer.play_buffer(ones(10), 1, start=1.0)
+    mixer.cancel(action)
+    output = zeros(SAMPLERATE + BLOCKSIZE)
+    mixer.process(output)
+    assert not any(output)
+    assert action not in mixer.actions
+    assert action.done_frames == 0
+
+
+def test_wait(mixer):
+    action = mixer.play_buffer(ones(10), 1, start=1.0)
+    assert not mixer.wait(action, timeout=0.01)
+    mixer.process(frames=SAMPLERATE + BLOCKSIZE)
+    assert mixer.wait(action, timeout=1)
+    assert mixer.wait(timeout=1)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Measure the run time of the audio callback without audio hardware.
+
+The C function callback() is called directly (via the CFFI "lib" object)
+with synthetic input/output buffers, using the state (and the action
+queue) of an rtmixer.OfflineMixerAndRecorder.
+
+For each combination of action type, number of active actions, number
+of device channels, channel mapping layout and block size, the run time
+of each callback invocation is measured.
+The results are written to a JSON file, which can be used to compare
+the results between different commits, e.g.:
+
+    python3 tools/benchmark_callback.py -o before.json
+    git checkout ...
+    python3 tools/benchmark_callback.py -o after.json
+
+NB: The measured times include the overhead of calling the C function
+from Python, which is a constant offset per block.
+
+"""
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import rtmixer
+from _rtmixer import ffi, lib
+
+ACTION_TYPES = {
+    'PLAY_BUFFER': rtmixer.PLAY_BUFFER,
+    'PLAY_RINGBUFFER': rtmixer.PLAY_RINGBUFFER,
+    'RECORD_BUFFER': rtmixer.RECORD_BUFFER,
+    'RECORD_RINGBUFFER': rtmixer.RECORD_RINGBUFFER,
+}
+LAYOUTS = 'identity', 'offset', 'scattered', 'mono'
+SAMPLERATE = 48000
+SAMPLESIZE = 4
+
+
+def get_mapping(layout, channels):
+    """Return channel mapping for the given layout and device channels."""
+    if layout == 'identity':
+        return list(range(1, channels + 1))
+    elif layout == 'offset':
+        half = max(channels // 2, 1)
+        return list(range(channels - half + 1, channels + 1))
+    elif layout == 'scattered':
+        return list(range(channels, 0, -1))
+    elif layout == 'mono':
+        return [channels]
+    raise ValueError('Invalid layout: {!r}'.format(layout))
+
+
+def next_power_of_2(value):
+    return 1 << max(value - 1, 1).bit_length()
+
+
+def measure(typename, actions, channels, layout, blocksize, blocks, warmup):
+    """Return a dictionary with timing results of a single configuration."""
+    mapping = get_mapping(layout, channels)
+    total_blocks = warmup + blocks
+    stream = rtmixer.OfflineMixerAndRecorder(
+        channels=channels, samplerate=SAMPLERATE, blocksize=blocksize,
+        qsize=next_power_of_2(actions))
+    elementsize = len(mapping) * SAMPLESIZE
+    if typename.endswith('_BUFFER'):
+        # All actions share the same buffer, this doesn't matter here.
+        # One additional block keeps the actions alive until the end.
+        buffer = bytearray((total_blocks + 1) * blocksize * elementsize)
+    else:
+        ringbuffers = [
+            rtmixer.RingBuffer(elementsize, next_power_of_2(2 * blocksize))
+            for _ in range(actions)]
+    for i in range(actions):
+        if typename == 'PLAY_BUFFER':
+            stream.play_buffer(buffer, channels=mapping)
+        elif typename == 'RECORD_BUFFER':
+            stream.record_buffer(buffer, channels=mapping)
+        elif typename == 'PLAY_RINGBUFFER':
+            stream.play_ringbuffer(ringbuffers[i], channels=mapping)
+        elif typename == 'RECORD_RINGBUFFER':
+            stream.record_ringbuffer(ringbuffers[i], channels=mapping)
+        else:
+            raise ValueError('Invalid action type: {!r}'.format(typename))
+    input = ffi.new('float[]', blocksize * channels)
+    output = ffi.new('float[]', blocksize * channels)
+    time_info = ffi.new('PaStreamCallbackTimeInfo*')
+    state = stream._state
+    callback = lib.callback
+    perf_counter_ns = time.perf_counter_ns
+    durations = []
+    for block in range(total_blocks):
+        # Ring buffers are kept full/empty (data doesn't matter):
+        if typename == 'PLAY_RINGBUFFER':
+            for rb in ringbuffers:
+                rb.advance_write_index(rb.write_available)
+        elif typename == 'RECORD_RINGBUFFER':
+            for rb in ringbuffers:
+                rb.advance_read_index(rb.read_available)
+        now = block * blocksize / SAMPLERATE
+        time_info.inputBufferAdcTime = now
+        time_info.currentTime = now
+        time_info.outputBufferDacTime = now
+        start = perf_counter_ns()
+        ret = callback(input, output, blocksize, time_info, 0, state)
+        stop = perf_counter_ns()
+        if ret != lib.paContinue:
+            raise RuntimeError('Audio callback was aborted')
+        if block >= warmup:
+            durations.append(stop - start)
+    if len(stream.actions) != actions:
+        raise RuntimeError('Not all actions were active until the end')
+    durations.sort()
+    median = statistics.median(durations)
+    return {
+        'action_type': typename,
+        'actions': actions,
+        'channels': channels,
+        'layout': layout,
+        'action_channels': len(mapping),
+        'blocksize': blocksize,
+        'blocks': blocks,
+        'ns_per_frame': median / blocksize,
+        'ns_per_frame_and_action': median / blocksize / actions,
+        'block_ns_median': median,
+        'block_ns_mean': statistics.fmean(durations),
+        'block_ns_p99': durations[int(0.99 * (len(durations) - 1))],
+        'block_ns_max': durations[-1],
+        'block_duration_ns': blocksize * 1e9 / SAMPLERATE,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '-o', '--output', metavar='FILENAME',
+        default='callback_benchmark.json',
+        help='JSON output file (default: %(default)s)')
+    parser.add_argument(
+        '--types', nargs='+', choices=list(ACTION_TYPES),
+        default=list(ACTION_TYPES), help='action types')
+    parser.add_argument(
+        '--actions', nargs='+', type=int, default=[1, 16, 128],
+        help='numbers of simultaneously active actions')
+    parser.add_argument(
+        '--channels', nargs='+', type=int, default=[2, 64],
+        help='numbers of device channels')
+    parser.add_argument(
+        '--layouts', nargs='+', choices=LAYOUTS, default=list(LAYOUTS),
+        help='channel mapping layouts')
+    parser.add_argument(
+        '--blocksizes', nargs='+', type=int, default=[64, 256, 1024],
+        help='block sizes in frames')
+    parser.add_argument(
+        '--blocks', type=int, default=200,
+        help='number of measured blocks per configuration')
+    parser.add_argument(
+        '--warmup', type=int, default=10,
+        help='number of blocks before measurement starts')
+    args = parser.parse_args()
+
+    results = []
+    for config in itertools.product(args.types, args.actions, args.channels,
+                                    args.layouts, args.blocksizes):
+        result = measure(*config, blocks=args.blocks, warmup=args.warmup)
+        print('{action_type:17} {actions:4} actions {channels:3} channels '
+              '{layout:9} {blocksize:5} frames: {ns_per_frame:10.1f} ns/frame '
+              '(max block: {block_ns_max:9.0f} ns)'.format(**result))
+        results.append(result)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'rtmixer_version': rtmixer.__version__,
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'system': platform.system(),
+            'samplerate': SAMPLERATE,
+            'results': results,
+        }, f, indent=2)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    main()